@@ -1,7 +1,17 @@
 
 from flask import Flask
 from flask_cors import CORS
-from app.db import init_db, migrate_existing_users
+from app.db import init_db, init_app as init_db_app
+from app.stats import reconcile_job
+from app.sessions import flush_last_seen, sweep_expired_sessions
+from app.timeline import trim_timelines
+from app.store import room_store
+from app.scheduler import scheduler
+from app.membership import membership
+from app.trending import trending
+from app.utils import ping_upload_service
+from app.config import (STATS_RECONCILE_INTERVAL, SESSION_FLUSH_INTERVAL, SESSION_SWEEP_INTERVAL,
+                        KEEPALIVE_INTERVAL, CHAT_EXPIRY_INTERVAL, TIMELINE_TRIM_INTERVAL, BROKER_SOCKET)
 
 def create_app():
     app = Flask(__name__)
@@ -12,7 +22,29 @@ def create_app():
     
     # Initialize DB
     init_db()
-    migrate_existing_users()
+    init_db_app(app)
+
+    # background housekeeping, one scheduler per process
+    scheduler.add_job('stats-reconcile', STATS_RECONCILE_INTERVAL, reconcile_job)
+    scheduler.add_job('session-flush', SESSION_FLUSH_INTERVAL, flush_last_seen, run_now=False)
+    scheduler.add_job('session-sweep', SESSION_SWEEP_INTERVAL, sweep_expired_sessions)
+    scheduler.add_job('timeline-trim', TIMELINE_TRIM_INTERVAL, trim_timelines, run_now=False)
+    scheduler.add_job('chat-expiry', CHAT_EXPIRY_INTERVAL, room_store.expire, run_now=False)
+    scheduler.add_job('upload-keepalive', KEEPALIVE_INTERVAL, ping_upload_service)
+    scheduler.start()
+
+    # room messages, joins and hashtags from the other worker processes
+    if BROKER_SOCKET:
+        try:
+            from app.broker import broker
+        except ImportError as e:
+            # needs fcntl and Unix domain sockets, each worker keeps to itself
+            print(f'Broker disabled: {e}')
+        else:
+            room_store.use_broker(broker)
+            membership.use_broker(broker)
+            trending.use_broker(broker)
+            broker.start()
 
     # Register Blueprints
     from app.routes.auth import auth_bp
@@ -33,4 +65,7 @@ def create_app():
     app.register_blueprint(upload_bp)
     app.register_blueprint(misc_bp)
 
+    from app.sockets import init_app as init_sockets
+    init_sockets(app)
+
     return app
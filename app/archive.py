@@ -0,0 +1,167 @@
+import bisect
+import json
+import mmap
+import os
+import struct
+import zlib
+from app.config import ROOM_ARCHIVE_DIR, ARCHIVE_BLOCK_MESSAGES
+
+# Room history that has left the room_messages table (retention or quota),
+# kept so clients can still scroll back through it.
+#
+# Each room has three files:
+#   room_<id>.seg   zlib-compressed blocks, each a JSON list of exactly
+#                   ARCHIVE_BLOCK_MESSAGES messages in id order
+#   room_<id>.idx   one fixed-size record per block:
+#                   first id, last id, offset and length in the .seg file
+#   room_<id>.tail  archived messages that do not fill a block yet, one
+#                   JSON object per line
+# Messages are archived in id order. They collect in the tail until there
+# are enough for a whole block, so a page read decompresses one block
+# (two at a boundary) however small the batches that expiry hands in. The
+# read binary-searches the index and goes through mmap.
+#
+# Appends only happen while the caller holds the database write lock
+# (BEGIN IMMEDIATE), which is what keeps workers from interleaving them.
+# Block data is written before its index record, and the index record
+# before the tail is cut back, so a crash at any point leaves at worst
+# unreferenced block bytes (cut off by the next append) or tail lines that
+# are already in a block (skipped by id).
+
+_RECORD = struct.Struct('>qqQI')
+
+def _read_file(path):
+    """mmap'ed contents of a file, or None if it is missing or empty."""
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        return None
+
+def _write_synced(path, data, mode):
+    with open(path, mode) as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+def _encode_lines(messages):
+    return b''.join(json.dumps(m, separators=(',', ':')).encode('utf-8') + b'\n' for m in messages)
+
+class RoomArchive:
+
+    def __init__(self, directory=ROOM_ARCHIVE_DIR, block_messages=ARCHIVE_BLOCK_MESSAGES):
+        self.directory = directory
+        self.block_messages = block_messages
+
+    def _paths(self, room_id):
+        base = os.path.join(self.directory, f'room_{int(room_id)}')
+        return base + '.seg', base + '.idx', base + '.tail'
+
+    def _records(self, idx):
+        return [_RECORD.unpack_from(idx, i * _RECORD.size) for i in range(len(idx) // _RECORD.size)]
+
+    def _read_records(self, idx_path):
+        idx = _read_file(idx_path)
+        if idx is None:
+            return []
+        try:
+            return self._records(idx)
+        finally:
+            idx.close()
+
+    def _read_tail(self, tail_path, after_id, repair=False):
+        """Tail messages with an id above after_id, oldest first.
+
+        A torn last line (crash, or an append still being written) is
+        ignored; with repair=True it is also cut off the file.
+        """
+        try:
+            with open(tail_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        end = data.rfind(b'\n') + 1
+        if repair and end < len(data):
+            with open(tail_path, 'r+b') as f:
+                f.truncate(end)
+        messages = [json.loads(line) for line in data[:end].splitlines()]
+        return [m for m in messages if m['id'] > after_id]
+
+    def _repair(self, seg_path, idx_path):
+        # drop a torn index record and block bytes no record points to
+        if os.path.exists(idx_path):
+            size = os.path.getsize(idx_path)
+            if size % _RECORD.size:
+                with open(idx_path, 'r+b') as f:
+                    f.truncate(size - size % _RECORD.size)
+        records = self._read_records(idx_path)
+        end = records[-1][2] + records[-1][3] if records else 0
+        if os.path.exists(seg_path) and os.path.getsize(seg_path) > end:
+            with open(seg_path, 'r+b') as f:
+                f.truncate(end)
+        return records[-1][1] if records else 0, end
+
+    def append(self, room_id, messages):
+        """Archive messages (dicts with an 'id'), returns how many were written.
+
+        Callers archive in id order, so ids at or below the room's newest
+        archived one are already here; skipping them means retrying after a
+        rolled back delete does not duplicate anything.
+        """
+        seg_path, idx_path, tail_path = self._paths(room_id)
+        os.makedirs(self.directory, exist_ok=True)
+        last_block_id, offset = self._repair(seg_path, idx_path)
+        tail = self._read_tail(tail_path, last_block_id, repair=True)
+        last_id = tail[-1]['id'] if tail else last_block_id
+        messages = sorted((m for m in messages if m['id'] > last_id), key=lambda m: m['id'])
+        if not messages:
+            return 0
+
+        pending = tail + messages
+        full = len(pending) - len(pending) % self.block_messages
+        if not full:
+            _write_synced(tail_path, _encode_lines(messages), 'ab')
+            return len(messages)
+
+        blocks = []
+        records = []
+        for start in range(0, full, self.block_messages):
+            chunk = pending[start:start + self.block_messages]
+            block = zlib.compress(json.dumps(chunk, separators=(',', ':')).encode('utf-8'))
+            blocks.append(block)
+            records.append(_RECORD.pack(chunk[0]['id'], chunk[-1]['id'], offset, len(block)))
+            offset += len(block)
+        _write_synced(seg_path, b''.join(blocks), 'ab')
+        _write_synced(idx_path, b''.join(records), 'ab')
+        # the rest becomes the new tail, swapped in whole so readers see old or new
+        _write_synced(tail_path + '.tmp', _encode_lines(pending[full:]), 'wb')
+        os.replace(tail_path + '.tmp', tail_path)
+        return len(messages)
+
+    def read_before(self, room_id, before_id, limit):
+        """Up to `limit` archived messages with an id below before_id, oldest first."""
+        seg_path, idx_path, tail_path = self._paths(room_id)
+        records = self._read_records(idx_path)
+        last_block_id = records[-1][1] if records else 0
+        page = [m for m in self._read_tail(tail_path, last_block_id) if m['id'] < before_id]
+        if len(page) >= limit or not records:
+            return page[-limit:]
+        seg = _read_file(seg_path)
+        if seg is None:
+            return page[-limit:]
+
+        # last block that starts below the cursor, then walk back as needed
+        i = bisect.bisect_left([r[0] for r in records], before_id) - 1
+        try:
+            while i >= 0 and len(page) < limit:
+                _, _, offset, length = records[i]
+                if offset + length > len(seg):
+                    break
+                block = json.loads(zlib.decompress(seg[offset:offset + length]))
+                page = [m for m in block if m['id'] < before_id] + page
+                i -= 1
+        finally:
+            seg.close()
+        return page[-limit:]
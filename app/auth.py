@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import OrderedDict
+from flask import g, request
+from app.sessions import lookup_session, hash_token, touch_session
+from app.tokens import looks_signed, verify_token
+from app.config import AUTH_CACHE_SIZE, AUTH_CACHE_TTL
+
+class TokenCache:
+    """Bounded token -> username map with a TTL, evicting least recently used.
+
+    Entries only live for AUTH_CACHE_TTL seconds so a logout handled by
+    another worker process is picked up quickly here as well.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # token -> (username, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[token]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, token, username):
+        with self._lock:
+            self._entries[token] = (username, time.monotonic() + self.ttl)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token):
+        with self._lock:
+            self._entries.pop(token, None)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0
+            }
+
+token_cache = TokenCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+
+def resolve_token(token):
+    """Username owning `token`, or None."""
+    if not token:
+        return None
+    if looks_signed(token):
+        return verify_token(token)
+    username = token_cache.get(token)
+    if username is not None:
+        touch_session(hash_token(token))
+        return username
+
+    username = lookup_session(token)
+    if username is not None:
+        token_cache.put(token, username)
+    return username
+
+def current_user():
+    """Username for this request's Authorization header, resolved once per request."""
+    if '_current_user' not in g:
+        g._current_user = resolve_token(request.headers.get('Authorization'))
+    return g._current_user
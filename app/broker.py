@@ -0,0 +1,307 @@
+import fcntl
+import json
+import os
+import queue
+import selectors
+import socket
+import struct
+import threading
+import time
+from app.config import (BROKER_SOCKET, BROKER_MAX_BUFFER, BROKER_QUEUE_LIMIT, BROKER_MAX_FRAME,
+                        BROKER_RECONNECT_DELAY)
+
+# Local pub/sub between the worker processes of one machine.
+#
+# Workers connect to a broker over a Unix domain socket and exchange
+# length-prefixed JSON frames (4 byte big-endian size, then the payload):
+#   {'op': 'sub' | 'unsub', 'topic': ...}
+#   {'op': 'pub', 'topic': ..., 'data': ...}   from a worker
+#   {'op': 'msg', 'topic': ..., 'data': ...}   to every other subscriber
+# The first worker to take the lock file runs the broker in a thread; it
+# can also run on its own with `python -m app.broker`. When the broker
+# goes away the workers reconnect and one of them takes over.
+#
+# Backpressure: a subscriber whose unsent frames pile up past
+# BROKER_MAX_BUFFER bytes is disconnected (it resubscribes and resyncs
+# from the database), and a worker whose outbox is full drops the event
+# instead of blocking the request that published it.
+
+if not hasattr(socket, 'AF_UNIX'):
+    raise ImportError('Unix domain sockets are not available on this platform')
+
+_HEADER = struct.Struct('>I')
+
+def encode_frame(obj):
+    payload = json.dumps(obj).encode('utf-8')
+    return _HEADER.pack(len(payload)) + payload
+
+class FrameReader:
+    """Splits a byte stream back into frames."""
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def feed(self, data):
+        self._buf += data
+        frames = []
+        while len(self._buf) >= _HEADER.size:
+            (size,) = _HEADER.unpack_from(self._buf)
+            if size > BROKER_MAX_FRAME:
+                raise ValueError(f'frame of {size} bytes is too large')
+            end = _HEADER.size + size
+            if len(self._buf) < end:
+                break
+            frames.append(json.loads(self._buf[_HEADER.size:end]))
+            del self._buf[:end]
+        return frames
+
+class _Peer:
+    __slots__ = ('sock', 'reader', 'out', 'topics')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = FrameReader()
+        self.out = bytearray()
+        self.topics = set()
+
+class Broker:
+    """The broker side: one selector loop over all worker connections."""
+
+    def __init__(self, listener, max_buffer=BROKER_MAX_BUFFER):
+        self.listener = listener
+        self.max_buffer = max_buffer
+        self._sel = selectors.DefaultSelector()
+        self._topics = {}  # topic -> set of _Peer
+
+    def serve_forever(self):
+        self.listener.setblocking(False)
+        self._sel.register(self.listener, selectors.EVENT_READ, None)
+        while True:
+            for key, mask in self._sel.select():
+                if key.data is None:
+                    self._accept()
+                    continue
+                peer = key.data
+                try:
+                    if mask & selectors.EVENT_READ:
+                        self._read(peer)
+                    if mask & selectors.EVENT_WRITE and peer.sock.fileno() != -1:
+                        self._flush(peer)
+                except (OSError, ValueError):
+                    self._drop(peer)
+
+    def _accept(self):
+        try:
+            sock, _ = self.listener.accept()
+        except OSError:
+            return
+        sock.setblocking(False)
+        self._sel.register(sock, selectors.EVENT_READ, _Peer(sock))
+
+    def _read(self, peer):
+        data = peer.sock.recv(65536)
+        if not data:
+            self._drop(peer)
+            return
+        for frame in peer.reader.feed(data):
+            op = frame.get('op')
+            topic = frame.get('topic')
+            if op == 'sub':
+                peer.topics.add(topic)
+                self._topics.setdefault(topic, set()).add(peer)
+            elif op == 'unsub':
+                peer.topics.discard(topic)
+                self._topics.get(topic, set()).discard(peer)
+            elif op == 'pub':
+                # encoded once, the same bytes go to every subscriber
+                out = encode_frame({'op': 'msg', 'topic': topic, 'data': frame.get('data')})
+                for other in list(self._topics.get(topic, ())):
+                    if other is not peer:
+                        self._queue(other, out)
+
+    def _queue(self, peer, frame):
+        if len(peer.out) + len(frame) > self.max_buffer:
+            print('Broker: dropping slow subscriber')
+            self._drop(peer)
+            return
+        was_idle = not peer.out
+        peer.out += frame
+        if was_idle:
+            self._sel.modify(peer.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, peer)
+
+    def _flush(self, peer):
+        sent = peer.sock.send(peer.out)
+        del peer.out[:sent]
+        if not peer.out:
+            self._sel.modify(peer.sock, selectors.EVENT_READ, peer)
+
+    def _drop(self, peer):
+        for topic in peer.topics:
+            subscribers = self._topics.get(topic)
+            if subscribers is not None:
+                subscribers.discard(peer)
+                if not subscribers:
+                    del self._topics[topic]
+        peer.topics.clear()
+        if peer.sock.fileno() != -1:
+            self._sel.unregister(peer.sock)
+            peer.sock.close()
+
+def _take_broker_lock(path):
+    """Lock file that makes exactly one process the broker, None if taken."""
+    fd = os.open(path + '.lock', os.O_CREAT | os.O_RDWR, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+def _bind(path):
+    # we hold the lock, so whatever socket file is there is stale
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(128)
+    return listener
+
+class BrokerClient:
+    """A worker's connection to the broker.
+
+    publish() never blocks: frames go through a bounded outbox drained by a
+    sender thread. Handlers run on the reader thread.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connected = False
+        self.role = 'client'
+        self._handlers = {}  # topic -> callable(data)
+        self._on_connect = []
+        self._outbox = queue.Queue(BROKER_QUEUE_LIMIT)
+        self._sock = None
+        self._send_lock = threading.Lock()
+        self._state_lock = threading.Lock()  # orders subscribe() against a reconnect
+        self._lock_fd = None
+        self._pid = None
+        self._counts = {'published': 0, 'received': 0, 'dropped': 0, 'reconnects': 0}
+
+    def start(self):
+        """Connect in the background, at most once per process."""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._run, name='broker-client', daemon=True).start()
+        threading.Thread(target=self._send_loop, name='broker-sender', daemon=True).start()
+
+    def on_connect(self, callback):
+        """Called after every (re)connect; events may have been missed before it."""
+        self._on_connect.append(callback)
+
+    def subscribe(self, topic, handler):
+        with self._state_lock:
+            self._handlers[topic] = handler
+            self._enqueue({'op': 'sub', 'topic': topic})
+
+    def unsubscribe(self, topic):
+        if self._handlers.pop(topic, None) is not None:
+            self._enqueue({'op': 'unsub', 'topic': topic})
+
+    def publish(self, topic, data):
+        if self._enqueue({'op': 'pub', 'topic': topic, 'data': data}):
+            self._counts['published'] += 1
+
+    def stats(self):
+        return {'role': self.role, 'connected': self.connected, 'topics': len(self._handlers), **self._counts}
+
+    def _enqueue(self, frame):
+        if not self.connected:
+            # subscriptions are sent again on connect, events are lost anyway
+            return False
+        try:
+            self._outbox.put_nowait(encode_frame(frame))
+            return True
+        except queue.Full:
+            self._counts['dropped'] += 1
+            return False
+
+    def _send_loop(self):
+        while True:
+            frame = self._outbox.get()
+            sock = self._sock
+            if sock is None or not self.connected:
+                continue
+            try:
+                with self._send_lock:
+                    sock.sendall(frame)
+            except OSError:
+                self.connected = False
+
+    def _serve(self):
+        self._lock_fd = _take_broker_lock(self.path)
+        if self._lock_fd is None:
+            return
+        listener = _bind(self.path)
+        self.role = 'broker'
+        threading.Thread(target=Broker(listener).serve_forever, name='broker', daemon=True).start()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            return sock
+        except OSError:
+            sock.close()
+        if self._lock_fd is None:
+            self._serve()
+        return None
+
+    def _run(self):
+        while True:
+            sock = self._connect()
+            if sock is None:
+                time.sleep(BROKER_RECONNECT_DELAY)
+                continue
+            try:
+                with self._state_lock, self._send_lock:
+                    for topic in list(self._handlers):
+                        sock.sendall(encode_frame({'op': 'sub', 'topic': topic}))
+                    self._sock = sock
+                    self.connected = True
+                for callback in self._on_connect:
+                    callback()
+                self._read(sock)
+            except (OSError, ValueError) as e:
+                print(f'Broker connection lost: {e}')
+            self.connected = False
+            self._sock = None
+            sock.close()
+            self._counts['reconnects'] += 1
+            time.sleep(BROKER_RECONNECT_DELAY)
+
+    def _read(self, sock):
+        reader = FrameReader()
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                return
+            for frame in reader.feed(data):
+                handler = self._handlers.get(frame.get('topic'))
+                if handler is None:
+                    continue
+                self._counts['received'] += 1
+                try:
+                    handler(frame.get('data'))
+                except Exception as e:
+                    print(f'Broker handler failed: {e}')
+
+# per-process connection, started by create_app()
+broker = BrokerClient(BROKER_SOCKET)
+
+if __name__ == '__main__':
+    lock_fd = _take_broker_lock(BROKER_SOCKET)
+    if lock_fd is None:
+        raise SystemExit(f'another broker already holds {BROKER_SOCKET}.lock')
+    print(f'Broker listening on {BROKER_SOCKET}')
+    Broker(_bind(BROKER_SOCKET)).serve_forever()
@@ -1,10 +1,74 @@
 
 # Configuration
+import os
+import secrets
 
 DB_FILE = "db.sqlite"
-MAX_MESSAGES = 100
-MESSAGE_LIFESPAN = 60 * 30 * 30  
-MESSAGES_FILE = "messages.txt"
+DB_POOL_SIZE = 16            # max pooled connections per process
+DB_POOL_TIMEOUT = 10         # seconds to wait for a free connection
+DB_BUSY_TIMEOUT_MS = 5000
+DB_CACHE_SIZE_KB = 20000     # page cache per connection
+DB_MMAP_SIZE = 256 * 1024 * 1024
+# 'opaque' hands out random tokens kept (hashed) in the sessions table,
+# 'signed' hands out HMAC-signed expiring tokens that are verified
+# without a database read
+AUTH_TOKEN_MODE = os.environ.get('MIRAGE_TOKEN_MODE', 'opaque')
+SECRET_KEY = os.environ.get('MIRAGE_SECRET_KEY', '')
+if AUTH_TOKEN_MODE == 'signed' and not SECRET_KEY:
+    SECRET_KEY = secrets.token_hex(32)
+    print("MIRAGE_SECRET_KEY not set, signed tokens will not survive a restart or work across workers")
+TOKEN_TTL = 7 * 24 * 60 * 60  # signed token lifetime, seconds
+REVOCATION_REFRESH = 30        # seconds between reloads of logout cutoffs
+HASH_WORKERS = max(1, (os.cpu_count() or 2) // 2)  # password hashing processes
+HASH_QUEUE_LIMIT = 32          # hashing requests allowed in flight before 503
+HASH_TIMEOUT = 10              # seconds
+AUTH_CACHE_SIZE = 10000       # cached token -> username entries
+AUTH_CACHE_TTL = 60           # seconds a cached token stays valid
+SESSION_TTL = 30 * 24 * 60 * 60   # opaque sessions expire after this long unused
+SESSION_FLUSH_INTERVAL = 30        # seconds between last_seen write-backs
+SESSION_SWEEP_INTERVAL = 60 * 60   # seconds between expired session sweeps
+KEEPALIVE_INTERVAL = 60            # seconds between upload service pings
+CHAT_EXPIRY_INTERVAL = 60          # seconds between expired room message sweeps
+SCHEDULER_WORKERS = 2              # threads running background jobs
+SCHEDULER_JITTER = 0.1             # +/- fraction of the interval
+TIMELINE_TRIM_INTERVAL = 10 * 60   # seconds between home timeline trims
+STATS_RECONCILE_INTERVAL = 5 * 60  # seconds between incremental stats reconciles
+TIMELINE_LENGTH = 500              # posts kept in each home timeline
+FANOUT_FOLLOWER_THRESHOLD = 1000   # authors with this many followers are pulled at read time instead
+# one /api/fyp page is made up of
+FEED_TIMELINE_POSTS = 12           # posts of followed accounts
+FEED_GLOBAL_POSTS = 12             # newest posts overall
+FEED_ARCHIVE_POSTS = 6             # oldest posts
+TRENDING_WINDOW = 60               # minutes of hashtag use counted for trending
+TRENDING_HALF_LIFE = 15            # minutes after which a use counts half
+TRENDING_TOP_K = 10                # tags served by /api/trending
+TRENDING_REFRESH = 5               # seconds between rebuilds of the top list
+HASHTAG_PAGE_SIZE = 20             # posts per /api/hashtag/<tag> page
+MAX_MESSAGES = 100                    # page size for room message reads
+MESSAGE_RETENTION = 60 * 30 * 30      # seconds room messages are kept
+ROOM_MAX_MESSAGES = 1000              # stored messages per room, rooms.max_messages overrides
+ROOM_MAX_BYTES = 1024 * 1024          # stored message text per room, rooms.max_bytes overrides
+ROOM_QUOTA_SLACK = 0.1                # a room over quota is trimmed to 90% of it
+MESSAGE_COMMIT_TIMEOUT = 2            # seconds a send waits for its group commit
+ROOM_CACHE_SIZE = 200                 # newest messages per room cached in each process
+ROOM_CACHE_MAX_BYTES = 256 * 1024     # message text cached per room in each process
+ROOM_PAYLOAD_CACHE_SIZE = 32          # encoded response bodies kept per room
+ROOM_CACHE_TTL = 1                    # seconds before a cached room is checked for new messages
+ROOM_ARCHIVE_DIR = "room_archive"     # segment files with history that left room_messages
+ARCHIVE_BLOCK_MESSAGES = 100          # messages per compressed archive block, fewer wait in a tail file
+MESSAGES_FILE = "messages.txt"        # legacy snapshot, imported into room_messages once
+MESSAGES_JOURNAL = "messages.jsonl"   # legacy journal, imported into room_messages once
+ROOM_CACHE_TTL_BROKER = 10            # same, while the broker delivers other workers' messages
+MEMBERSHIP_CACHE_TTL = 60             # seconds before cached room member lists are reloaded
+LONG_POLL_TIMEOUT = 25                # max seconds a wait_room_messages request is parked
+LONG_POLL_MAX_WAITERS = 200           # parked requests allowed per worker
+
+# Local pub/sub broker between worker processes (app/broker.py), '' turns it off
+BROKER_SOCKET = os.environ.get('MIRAGE_BROKER_SOCKET', 'broker.sock')
+BROKER_MAX_BUFFER = 1024 * 1024       # unsent bytes before a slow subscriber is dropped
+BROKER_MAX_FRAME = 1024 * 1024        # largest frame accepted
+BROKER_QUEUE_LIMIT = 1000             # frames a worker buffers before dropping events
+BROKER_RECONNECT_DELAY = 1            # seconds between connection attempts
 
 UPLOAD_URL = 'https://cpp-webserver.onrender.com/upload'
 
@@ -1,206 +1,480 @@
 
+import hashlib
+import importlib
+import json
+import os
 import sqlite3
-from app.config import DB_FILE
+import threading
+import time
+import queue
+from flask import g, has_app_context
+from app.config import (DB_FILE, DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_BUSY_TIMEOUT_MS,
+                        DB_CACHE_SIZE_KB, DB_MMAP_SIZE, SESSION_TTL,
+                        MESSAGES_FILE, MESSAGES_JOURNAL, TIMELINE_LENGTH, FANOUT_FOLLOWER_THRESHOLD)
 
-def get_db_connection():
-    conn = sqlite3.connect(DB_FILE)
-    # Optional: conn.row_factory = sqlite3.Row
-    return conn
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection that goes back to the pool instead of closing.
+
+    Route handlers still call conn.close() when they are done; for a pooled
+    connection that only rolls back whatever was not committed (same thing a
+    real close would do) and keeps the connection open for the next request.
+    """
+    pooled = False
+
+    def close(self):
+        if not self.pooled:
+            return super().close()
+        if self.in_transaction:
+            self.rollback()
+
+    def really_close(self):
+        super().close()
+
+# largest integer sqlite stores, ids and cursors from clients must fit
+MAX_INTEGER = 2 ** 63 - 1
+
+# idle connections + a semaphore bounding how many exist at once
+_idle = queue.LifoQueue()
+_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
 
-def migrate_existing_users():
-    conn = sqlite3.connect(DB_FILE)
+def _configure(conn):
     c = conn.cursor()
-    
-    # Ensure all columns exist in user_profile
+    c.execute('PRAGMA journal_mode=WAL')
+    c.execute('PRAGMA synchronous=NORMAL')
+    c.execute(f'PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT_MS)}')
+    c.execute(f'PRAGMA cache_size=-{int(DB_CACHE_SIZE_KB)}')
+    c.execute(f'PRAGMA mmap_size={int(DB_MMAP_SIZE)}')
+    c.execute('PRAGMA temp_store=MEMORY')
+    c.close()
+    return conn
+
+def connect(db_file=None):
+    """Open a standalone, tuned connection (startup code, background jobs)."""
+    conn = sqlite3.connect(db_file or DB_FILE, factory=PooledConnection,
+                           timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+    return _configure(conn)
+
+def _acquire():
+    if not _slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise sqlite3.OperationalError('database connection pool exhausted')
     try:
-        c.execute('ALTER TABLE user_profile ADD COLUMN upvotes INTEGER DEFAULT 0')
-        print("Added upvotes column to user_profile ✅")
-    except sqlite3.OperationalError as e:
-        if "duplicate column name" not in str(e):
-            print(f"Error adding upvotes to user_profile: {str(e)}")
+        conn = _idle.get_nowait()
+    except queue.Empty:
+        try:
+            conn = connect()
+        except Exception:
+            _slots.release()
+            raise
+        conn.pooled = True
+    return conn
 
+def _release(conn):
     try:
-        c.execute('ALTER TABLE user_profile ADD COLUMN downvotes INTEGER DEFAULT 0')
-        print("Added downvotes column to user_profile ✅")
-    except sqlite3.OperationalError as e:
-        if "duplicate column name" not in str(e):
-            print(f"Error adding downvotes to user_profile: {str(e)}")
-
-    # Get all existing users
-    c.execute('SELECT username FROM users')
-    users = c.fetchall()
-    
-    for (username,) in users:
-        # Check if user exists in user_profile
-        c.execute('SELECT 1 FROM user_profile WHERE username=?', (username,))
-        if not c.fetchone():
-            # Initialize stats for user
-            c.execute('''
-                INSERT INTO user_profile (username, followers, following, posts, upvotes, downvotes)
-                VALUES (?, 0, 0, 0, 0, 0)
-            ''', (username,))
-            
-        # Update stats based on actual data
-        # Update post count
-        c.execute('SELECT COUNT(*) FROM posts WHERE username=?', (username,))
-        post_count = c.fetchone()[0]
-        c.execute('UPDATE user_profile SET posts=? WHERE username=?', (post_count, username))
-        
-        # Update follower count
-        c.execute('SELECT COUNT(*) FROM following WHERE following=?', (username,))
-        follower_count = c.fetchone()[0]
-        c.execute('UPDATE user_profile SET followers=? WHERE username=?', (follower_count, username))
-        
-        # Update following count
-        c.execute('SELECT COUNT(*) FROM following WHERE follower=?', (username,))
-        following_count = c.fetchone()[0]
-        c.execute('UPDATE user_profile SET following=? WHERE username=?', (following_count, username))
-        
-        # Update upvotes/downvotes (sum of all votes on user's posts)
-        c.execute('SELECT SUM(upvotes), SUM(downvotes) FROM posts WHERE username=?', (username,))
-        up, down = c.fetchone()
-        up = up or 0
-        down = down or 0
-        c.execute('UPDATE user_profile SET upvotes=?, downvotes=? WHERE username=?', (up, down, username))
-    
-    conn.commit()
-    conn.close()
+        if conn.in_transaction:
+            conn.rollback()
+        _idle.put(conn)
+    except sqlite3.Error:
+        conn.really_close()
+    finally:
+        _slots.release()
 
+def get_db_connection():
+    """Connection for the current request.
 
-# init db
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
+    Inside an app context the same pooled connection is handed out for the
+    whole request and returned to the pool by close_db() at teardown.
+    Outside one (scripts, threads) you get a standalone connection.
+    """
+    if not has_app_context():
+        return connect()
+    if 'db_conn' not in g:
+        g.db_conn = _acquire()
+    return g.db_conn
+
+def close_db(exc=None):
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        _release(conn)
+
+def init_app(app):
+    app.teardown_appcontext(close_db)
+
+# Secondary indexes for the lookups the endpoints do on every request.
+# This is what migration 2 creates, so it must not change: new indexes
+# get a migration of their own (idx_users_token is dropped again by
+# migration 5).
+# name -> (table, columns)
+INDEXES = {
+    'idx_users_token': ('users', 'token'),
+    'idx_posts_username_created': ('posts', 'username, created_at'),
+    'idx_following_follower': ('following', 'follower, created_at'),
+    'idx_following_following': ('following', 'following, created_at'),
+    'idx_inbox_recipient': ('inbox_messages', 'recipient, created_at'),
+    'idx_inbox_sender': ('inbox_messages', 'sender, created_at'),
+    'idx_room_members_room_user': ('room_members', 'room_id, username'),
+    'idx_room_members_user_room': ('room_members', 'username, room_id'),
+    'idx_replies_post': ('replies', 'post_id, created_at'),
+}
+
+def ensure_indexes(c):
+    for name, (table, columns) in INDEXES.items():
+        c.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {table}({columns})')
+
+# Queries run on the hot path, with sample parameters. Each one is
+# registered with hot_query() where it is defined, so the text checked is
+# the text that runs; check_query_plans() makes sure none of them falls
+# back to a table scan.
+HOT_QUERIES = []
+
+# modules that register hot queries when they are imported
+_HOT_QUERY_MODULES = ('app.sessions', 'app.store', 'app.membership', 'app.trending', 'app.timeline',
+                      'app.routes.chat', 'app.routes.feed', 'app.routes.inbox', 'app.routes.posts',
+                      'app.routes.users')
+
+def hot_query(query, params):
+    """Register a hot query with sample parameters, returns the query."""
+    HOT_QUERIES.append((query, params))
+    return query
+
+def check_query_plans(conn):
+    """Run EXPLAIN QUERY PLAN over HOT_QUERIES.
+
+    Returns a list of (query, plan step) for every step that scans a table;
+    an empty list means every hot query is served by an index. Scanning
+    the result of a subquery (already cut down by its own search) is fine.
+    """
+    for module in _HOT_QUERY_MODULES:
+        importlib.import_module(module)
+    failures = []
     c = conn.cursor()
+    for query, params in HOT_QUERIES:
+        subqueries = set()
+        for row in c.execute('EXPLAIN QUERY PLAN ' + query, params).fetchall():
+            detail = row[3]
+            if detail.startswith(('MATERIALIZE ', 'CO-ROUTINE ')):
+                subqueries.add(detail.split(' ', 1)[1])
+            elif detail.startswith('SCAN') and detail.split(' ')[1] not in subqueries:
+                failures.append((' '.join(query.split()), detail))
+    return failures
 
-    # Create tables if they don't exist (without failing if they do)
-    tables = {
-        'users': '''CREATE TABLE IF NOT EXISTS users(
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL,
-                    email TEXT UNIQUE NOT NULL,
-                    avatar_url TEXT,
-                    description TEXT,
-                    password TEXT NOT NULL,
-                    token TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    custom_css TEXT,
-                    background_image TEXT
-                  )''',
-        'rooms': '''CREATE TABLE IF NOT EXISTS rooms (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT UNIQUE NOT NULL,
-                    is_private INTEGER DEFAULT 0,
-                    password_hash TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                  )''',
-        'room_members': '''CREATE TABLE IF NOT EXISTS room_members (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    room_id INTEGER NOT NULL,
-                    username TEXT NOT NULL,
-                    joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY(room_id) REFERENCES rooms(id),
-                    FOREIGN KEY(username) REFERENCES users(username)
-                  )''',
-        'inbox_messages': '''CREATE TABLE IF NOT EXISTS inbox_messages(
-                  id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  sender TEXT NOT NULL,
-                  recipient TEXT NOT NULL,
-                  message TEXT NOT NULL,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY(sender) REFERENCES users(username),
-                  FOREIGN KEY(recipient) REFERENCES users(username)
-                  )''',
-        'user_profile': '''CREATE TABLE IF NOT EXISTS user_profile (
-                  id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  username TEXT UNIQUE NOT NULL,
-                  followers INTEGER DEFAULT 0,
-                  following INTEGER DEFAULT 0,
-                  posts INTEGER DEFAULT 0,
-                  upvotes INTEGER DEFAULT 0,
-                  downvotes INTEGER DEFAULT 0,
-                  FOREIGN KEY(username) REFERENCES users(username)
-                  )''',
-        'posts': '''CREATE TABLE IF NOT EXISTS posts (
+# Base schema, created by migration 1
+TABLES = {
+    'users': '''CREATE TABLE IF NOT EXISTS users(
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT NOT NULL,
-                content TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                upvotes INTEGER DEFAULT 0,
-                downvotes INTEGER DEFAULT 0,
-                FOREIGN KEY(username) REFERENCES users(username)
-                )''',
-        'post_votes': '''CREATE TABLE IF NOT EXISTS post_votes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                post_id INTEGER NOT NULL,
-                username TEXT NOT NULL,
-                vote_type TEXT NOT NULL,
+                username TEXT UNIQUE NOT NULL,
+                email TEXT UNIQUE NOT NULL,
+                avatar_url TEXT,
+                description TEXT,
+                password TEXT NOT NULL,
+                token TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(post_id) REFERENCES posts(id),
-                FOREIGN KEY(username) REFERENCES users(username),
-                UNIQUE(post_id, username)
-                )''',
-        'following': '''CREATE TABLE IF NOT EXISTS following (
+                custom_css TEXT,
+                background_image TEXT
+              )''',
+    'rooms': '''CREATE TABLE IF NOT EXISTS rooms (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                follower TEXT NOT NULL,
-                following TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(follower) REFERENCES users(username),
-                FOREIGN KEY(following) REFERENCES users(username),
-                UNIQUE(follower, following)
-                )''',
-        'replies': '''CREATE TABLE IF NOT EXISTS replies (
+                name TEXT UNIQUE NOT NULL,
+                is_private INTEGER DEFAULT 0,
+                password_hash TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+              )''',
+    'room_members': '''CREATE TABLE IF NOT EXISTS room_members (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                post_id INTEGER NOT NULL,
+                room_id INTEGER NOT NULL,
                 username TEXT NOT NULL,
-                content TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(post_id) REFERENCES posts(id),
+                joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY(room_id) REFERENCES rooms(id),
                 FOREIGN KEY(username) REFERENCES users(username)
-                )'''
-    }
+              )''',
+    'inbox_messages': '''CREATE TABLE IF NOT EXISTS inbox_messages(
+              id INTEGER PRIMARY KEY AUTOINCREMENT,
+              sender TEXT NOT NULL,
+              recipient TEXT NOT NULL,
+              message TEXT NOT NULL,
+              created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+              FOREIGN KEY(sender) REFERENCES users(username),
+              FOREIGN KEY(recipient) REFERENCES users(username)
+              )''',
+    'user_profile': '''CREATE TABLE IF NOT EXISTS user_profile (
+              id INTEGER PRIMARY KEY AUTOINCREMENT,
+              username TEXT UNIQUE NOT NULL,
+              followers INTEGER DEFAULT 0,
+              following INTEGER DEFAULT 0,
+              posts INTEGER DEFAULT 0,
+              upvotes INTEGER DEFAULT 0,
+              downvotes INTEGER DEFAULT 0,
+              FOREIGN KEY(username) REFERENCES users(username)
+              )''',
+    'posts': '''CREATE TABLE IF NOT EXISTS posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            upvotes INTEGER DEFAULT 0,
+            downvotes INTEGER DEFAULT 0,
+            FOREIGN KEY(username) REFERENCES users(username)
+            )''',
+    'post_votes': '''CREATE TABLE IF NOT EXISTS post_votes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            post_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            vote_type TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(post_id) REFERENCES posts(id),
+            FOREIGN KEY(username) REFERENCES users(username),
+            UNIQUE(post_id, username)
+            )''',
+    'following': '''CREATE TABLE IF NOT EXISTS following (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            follower TEXT NOT NULL,
+            following TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(follower) REFERENCES users(username),
+            FOREIGN KEY(following) REFERENCES users(username),
+            UNIQUE(follower, following)
+            )''',
+    'replies': '''CREATE TABLE IF NOT EXISTS replies (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            post_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(post_id) REFERENCES posts(id),
+            FOREIGN KEY(username) REFERENCES users(username)
+            )'''
+}
 
-    # Create all tables
-    for table_name, create_stmt in tables.items():
+# Columns added after the first release. Databases created before them
+# get the columns added by migration 1.
+# table -> [(column, type)]
+ADDED_COLUMNS = {
+    'users': [('custom_css', 'TEXT'), ('background_image', 'TEXT')],
+    'posts': [('upvotes', 'INTEGER DEFAULT 0'), ('downvotes', 'INTEGER DEFAULT 0')],
+    'user_profile': [('upvotes', 'INTEGER DEFAULT 0'), ('downvotes', 'INTEGER DEFAULT 0')],
+}
+
+def _migration_base_schema(c):
+    for create_stmt in TABLES.values():
         c.execute(create_stmt)
-        print(f"Ensured {table_name} table exists")
+    for table, columns in ADDED_COLUMNS.items():
+        existing = {row[1] for row in c.execute(f'PRAGMA table_info({table})')}
+        for column, col_type in columns:
+            if column not in existing:
+                c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {col_type}')
 
-    # Now safely add columns if they don't exist
-    try:
-        c.execute('ALTER TABLE users ADD COLUMN custom_css TEXT')
-        print("Added custom_css column to users table ✅")
-    except sqlite3.OperationalError as e:
-        if "duplicate column name" in str(e):
-            print("custom_css column already exists in users table")
-        else:
-            print(f"Error adding custom_css column: {str(e)}")
+def _migration_stats_dirty(c):
+    # users whose user_profile counters need recomputing, see app/stats.py
+    c.execute('''CREATE TABLE IF NOT EXISTS stats_dirty (
+                username TEXT PRIMARY KEY
+                ) WITHOUT ROWID''')
+    triggers = {
+        'trg_stats_users_insert': ('AFTER INSERT ON users', ['NEW.username']),
+        'trg_stats_posts_insert': ('AFTER INSERT ON posts', ['NEW.username']),
+        'trg_stats_posts_delete': ('AFTER DELETE ON posts', ['OLD.username']),
+        'trg_stats_posts_votes': ('AFTER UPDATE OF upvotes, downvotes ON posts', ['NEW.username']),
+        'trg_stats_following_insert': ('AFTER INSERT ON following', ['NEW.follower', 'NEW.following']),
+        'trg_stats_following_delete': ('AFTER DELETE ON following', ['OLD.follower', 'OLD.following']),
+    }
+    for name, (event, columns) in triggers.items():
+        body = ' '.join(f'INSERT OR IGNORE INTO stats_dirty (username) VALUES ({col});' for col in columns)
+        c.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END')
+    # first reconcile after upgrading covers everybody
+    c.execute('INSERT OR IGNORE INTO stats_dirty (username) SELECT username FROM users')
 
-    try:
-        c.execute('ALTER TABLE users ADD COLUMN background_image TEXT')
-        print("Added background_image column to users table ✅")
-    except sqlite3.OperationalError as e:
-        if "duplicate column name" in str(e):
-            print("background_image column already exists in users table")
-        else:
-            print(f"Error adding background_image column: {str(e)}")
+def _migration_token_revocations(c):
+    # per-user logout cutoff for signed tokens, see app/tokens.py
+    c.execute('''CREATE TABLE IF NOT EXISTS token_revocations (
+                username TEXT PRIMARY KEY,
+                revoked_at REAL NOT NULL
+                )''')
+
+def _migration_sessions(c):
+    # one row per login keyed by the token hash, see app/sessions.py.
+    # WITHOUT ROWID keeps the rows in the primary key b-tree, so the auth
+    # lookup by token_hash never has to visit a separate table.
+    c.execute('''CREATE TABLE IF NOT EXISTS sessions (
+                token_hash TEXT PRIMARY KEY,
+                username TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_seen REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                FOREIGN KEY(username) REFERENCES users(username)
+                ) WITHOUT ROWID''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_sessions_username ON sessions(username)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)')
+
+    # carry over tokens of users that are logged in right now
+    now = time.time()
+    rows = c.execute('SELECT username, token FROM users WHERE token IS NOT NULL').fetchall()
+    c.executemany('''INSERT OR IGNORE INTO sessions (token_hash, username, created_at, last_seen, expires_at)
+                     VALUES (?, ?, ?, ?, ?)''',
+                  [(hashlib.sha256(token.encode('utf-8')).hexdigest(), username, now, now, now + SESSION_TTL)
+                   for username, token in rows])
+    c.execute('UPDATE users SET token=NULL WHERE token IS NOT NULL')
+    c.execute('DROP INDEX IF EXISTS idx_users_token')
+
+def _legacy_room_records():
+    # messages.jsonl (journal) or messages.txt (one JSON list) from before
+    # room messages moved into the database
+    records = []
+    if os.path.exists(MESSAGES_JOURNAL):
+        with open(MESSAGES_JOURNAL, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    elif os.path.exists(MESSAGES_FILE):
+        with open(MESSAGES_FILE, 'r', encoding='utf-8') as f:
+            try:
+                records = json.load(f)
+            except ValueError:
+                pass
+    return records
+
+def _migration_room_messages(c):
+    # room chat shared by every worker, see app/store.py. The primary key
+    # (room_id, id) doubles as the index for keyset reads of a room.
+    c.execute('''CREATE TABLE IF NOT EXISTS room_messages (
+                room_id INTEGER NOT NULL,
+                id INTEGER NOT NULL,
+                username TEXT NOT NULL,
+                message TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY(room_id, id)
+                ) WITHOUT ROWID''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_room_messages_created ON room_messages(created_at)')
+    # last id handed out per room, kept when the messages themselves expire
+    c.execute('''CREATE TABLE IF NOT EXISTS room_message_seq (
+                room_id INTEGER PRIMARY KEY,
+                last_id INTEGER NOT NULL
+                )''')
+
+    last_ids = {}
+    rows = []
+    for r in _legacy_room_records():
+        try:
+            room_id = int(r.get('room_id'))
+        except (TypeError, ValueError):
+            continue
+        if 'message' not in r:
+            last_ids[room_id] = max(last_ids.get(room_id, 0), r.get('last_id', 0))
+            continue
+        msg_id = r.get('id') or last_ids.get(room_id, 0) + 1
+        last_ids[room_id] = max(last_ids.get(room_id, 0), msg_id)
+        rows.append((room_id, msg_id, r.get('username'), r.get('message'), r.get('created_at')))
+    c.executemany('''INSERT OR IGNORE INTO room_messages (room_id, id, username, message, created_at)
+                     VALUES (?, ?, ?, ?, ?)''', rows)
+    c.executemany('INSERT OR REPLACE INTO room_message_seq (room_id, last_id) VALUES (?, ?)',
+                  list(last_ids.items()))
+
+def _migration_room_quotas(c):
+    # per-room caps (NULL = the ROOM_MAX_* defaults) and running totals
+    # to check them against, see RoomStore._enforce_quota
+    c.execute('ALTER TABLE rooms ADD COLUMN max_messages INTEGER')
+    c.execute('ALTER TABLE rooms ADD COLUMN max_bytes INTEGER')
+    c.execute('ALTER TABLE room_message_seq ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0')
+    c.execute('ALTER TABLE room_message_seq ADD COLUMN byte_count INTEGER NOT NULL DEFAULT 0')
+    c.execute('''UPDATE room_message_seq SET message_count = t.n, byte_count = t.bytes
+                 FROM (SELECT room_id, COUNT(*) AS n, SUM(length(CAST(message AS BLOB))) AS bytes
+                       FROM room_messages GROUP BY room_id) AS t
+                 WHERE room_message_seq.room_id = t.room_id''')
+
+def _migration_home_timeline(c):
+    # fan-out-on-write feed, see app/timeline.py. The primary key is the
+    # read order, so a feed page is one range of it.
+    c.execute('''CREATE TABLE IF NOT EXISTS home_timeline (
+                owner TEXT NOT NULL,
+                score INTEGER NOT NULL,
+                post_id INTEGER NOT NULL,
+                PRIMARY KEY(owner, score, post_id)
+                ) WITHOUT ROWID''')
+    # everybody starts with the newest posts of the accounts they follow
+    c.execute('''INSERT OR IGNORE INTO home_timeline (owner, score, post_id)
+                 SELECT owner, score, post_id FROM (
+                     SELECT f.follower AS owner, CAST(strftime('%s', p.created_at) AS INTEGER) AS score,
+                            p.id AS post_id, ROW_NUMBER() OVER (
+                                PARTITION BY f.follower ORDER BY p.created_at DESC, p.id DESC) AS rank
+                     FROM following f JOIN posts p ON p.username = f.following)
+                 WHERE rank <= ?''', (TIMELINE_LENGTH,))
+
+def _migration_post_hashtags(c):
+    # hashtags pulled out of posts once, at create_post, see app/trending.py
+    from app.trending import extract_hashtags
+    c.execute('''CREATE TABLE IF NOT EXISTS post_hashtags (
+                post_id INTEGER NOT NULL,
+                tag TEXT NOT NULL,
+                created_at TIMESTAMP NOT NULL,
+                PRIMARY KEY(post_id, tag)
+                ) WITHOUT ROWID''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_post_hashtags_created ON post_hashtags(created_at)')
+    c.execute('SELECT id, content, created_at FROM posts')
+    rows = [(post_id, tag, created_at) for post_id, content, created_at in c.fetchall()
+            for tag in extract_hashtags(content)]
+    c.executemany('INSERT OR IGNORE INTO post_hashtags (post_id, tag, created_at) VALUES (?,?,?)', rows)
 
+def _migration_hashtag_index(c):
+    # a tag's posts newest first as one range scan, and covering the
+    # (created_at, post_id) cursor so only the page itself touches posts
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_post_hashtags_tag
+                 ON post_hashtags(tag, created_at, post_id)''')
+
+def _migration_pulled_authors(c):
+    # authors whose posts fan-out skipped for being over the follower
+    # threshold, pushed once they drop back below it, see app/timeline.py
+    c.execute('''CREATE TABLE IF NOT EXISTS pulled_authors (
+                username TEXT PRIMARY KEY
+                ) WITHOUT ROWID''')
+    # anyone over the threshold now may have been skipped already
+    c.execute('''INSERT OR IGNORE INTO pulled_authors (username)
+                 SELECT username FROM user_profile WHERE followers >= ?''', (FANOUT_FOLLOWER_THRESHOLD,))
+
+# Numbered schema migrations: applying MIGRATIONS[N-1] moves the database
+# to PRAGMA user_version N. Only ever append to this list.
+MIGRATIONS = [
+    _migration_base_schema,  # 1
+    ensure_indexes,          # 2
+    _migration_stats_dirty,  # 3
+    _migration_token_revocations,  # 4
+    _migration_sessions,     # 5
+    _migration_room_messages,  # 6
+    _migration_room_quotas,  # 7
+    _migration_home_timeline,  # 8
+    _migration_post_hashtags,  # 9
+    _migration_hashtag_index,  # 10
+    _migration_pulled_authors,  # 11
+]
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def run_migrations(conn):
+    """Apply pending migrations in one transaction, returns how many ran."""
+    target = len(MIGRATIONS)
+    if schema_version(conn) >= target:
+        return 0
+
+    conn.isolation_level = None
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
     try:
-        c.execute('ALTER TABLE posts ADD COLUMN upvotes INTEGER DEFAULT 0')
-        print("Added upvotes column to posts table ✅")
-    except sqlite3.OperationalError as e:
-        if "duplicate column name" in str(e):
-            print("upvotes column already exists in posts table")
-        else:
-            print(f"Error adding upvotes column: {str(e)}")
+        # another worker may have migrated while we waited for the lock
+        current = schema_version(conn)
+        for version in range(current + 1, target + 1):
+            MIGRATIONS[version - 1](c)
+        c.execute(f'PRAGMA user_version={target}')
+        c.execute('COMMIT')
+    except Exception:
+        c.execute('ROLLBACK')
+        raise
+    return max(target - current, 0)
 
+# init db
+def init_db(db_file=None):
+    conn = connect(db_file)
     try:
-        c.execute('ALTER TABLE posts ADD COLUMN downvotes INTEGER DEFAULT 0')
-        print("Added downvotes column to posts table ✅")
-    except sqlite3.OperationalError as e:
-        if "duplicate column name" in str(e):
-            print("downvotes column already exists in posts table")
-        else:
-            print(f"Error adding downvotes column: {str(e)}")
-
-    conn.commit()
-    conn.close()
-    print("Database initialization completed")
+        applied = run_migrations(conn)
+    finally:
+        conn.really_close()
+    if applied:
+        print(f"Applied {applied} schema migration(s), database at version {len(MIGRATIONS)}")
@@ -0,0 +1,101 @@
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import generate_password_hash, check_password_hash
+from app.config import HASH_WORKERS, HASH_QUEUE_LIMIT, HASH_TIMEOUT
+
+# Password hashing is slow on purpose. Running it on the request thread
+# lets a burst of logins starve every other endpoint of the worker, so it
+# goes to a small process pool instead, with a cap on how many requests
+# may be waiting for it at once. The workers are spawned rather than
+# forked, the app process is full of threads by the time the pool starts.
+
+class HashingBusy(Exception):
+    """Hashing is overloaded (queue full, timed out) or its pool died."""
+
+_executor = None
+_executor_lock = threading.Lock()
+_inflight = threading.BoundedSemaphore(HASH_QUEUE_LIMIT)
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ProcessPoolExecutor(max_workers=HASH_WORKERS,
+                                                mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
+def _discard_executor(executor):
+    # a worker died, the pool is unusable; the next request starts a new one
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def _record(op, elapsed=None, outcome=None):
+    """Count a finished operation, or one that was 'rejected', 'timeouts' or 'failures'."""
+    with _metrics_lock:
+        m = _metrics.setdefault(op, {'count': 0, 'rejected': 0, 'timeouts': 0, 'failures': 0,
+                                     'total_ms': 0.0, 'max_ms': 0.0})
+        if outcome is not None:
+            m[outcome] += 1
+            return
+        ms = elapsed * 1000
+        m['count'] += 1
+        m['total_ms'] += ms
+        m['max_ms'] = max(m['max_ms'], ms)
+
+def _run(op, fn, *args):
+    if not _inflight.acquire(blocking=False):
+        _record(op, outcome='rejected')
+        raise HashingBusy()
+    started = time.perf_counter()
+    executor = _get_executor()
+    try:
+        future = executor.submit(fn, *args)
+    except (BrokenProcessPool, RuntimeError):
+        _inflight.release()
+        _discard_executor(executor)
+        _record(op, outcome='failures')
+        raise HashingBusy()
+    # the slot is freed when the task is done, not when we give up waiting,
+    # so timed out tasks still count against HASH_QUEUE_LIMIT
+    future.add_done_callback(lambda f: _inflight.release())
+    try:
+        result = future.result(timeout=HASH_TIMEOUT)
+    except FutureTimeout:
+        _record(op, outcome='timeouts')
+        raise HashingBusy()
+    except BrokenProcessPool:
+        _discard_executor(executor)
+        _record(op, outcome='failures')
+        raise HashingBusy()
+    _record(op, time.perf_counter() - started)
+    return result
+
+def hash_password(password):
+    return _run('hash', generate_password_hash, password)
+
+def verify_password(stored_hash, password):
+    return _run('verify', check_password_hash, stored_hash, password)
+
+def stats():
+    with _metrics_lock:
+        return {
+            op: {
+                'count': m['count'],
+                'rejected': m['rejected'],
+                'timeouts': m['timeouts'],
+                'failures': m['failures'],
+                'avg_ms': round(m['total_ms'] / m['count'], 2) if m['count'] else 0.0,
+                'max_ms': round(m['max_ms'], 2)
+            }
+            for op, m in _metrics.items()
+        }
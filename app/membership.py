@@ -0,0 +1,122 @@
+import threading
+import time
+from app.db import get_db_connection, hot_query
+from app.config import MEMBERSHIP_CACHE_TTL
+
+_ROOM_MEMBERS = hot_query('SELECT username FROM room_members WHERE room_id=?', (1,))
+_USER_ROOMS = hot_query('SELECT room_id FROM room_members WHERE username=?', ('u',))
+
+class MembershipCache:
+    """Who is in which room, kept in memory for the chat authorization checks.
+
+    Both directions (room -> usernames, username -> room ids) are loaded
+    lazily from room_members and updated by create_room/join_room. Nobody
+    ever leaves a room, so a cached "yes" is always right and costs no
+    SQL; a "no" reloads the user's rooms from the table, since the user
+    may have joined through another worker. Joins on other workers arrive over
+    the broker, and entries are reloaded after MEMBERSHIP_CACHE_TTL in
+    case one was missed.
+    """
+
+    def __init__(self, ttl=MEMBERSHIP_CACHE_TTL):
+        self.ttl = ttl
+        self._rooms = {}  # room_id -> (dict of usernames used as an ordered set, loaded_at)
+        self._users = {}  # username -> (set of room ids, loaded_at)
+        self._lock = threading.Lock()
+        self.broker = None
+        self.hits = 0
+        self.misses = 0
+
+    def use_broker(self, broker):
+        if self.broker is broker:
+            return
+        self.broker = broker
+        broker.subscribe('room_members', lambda data: self._add(data['room_id'], data['username']))
+        broker.on_connect(self.clear)
+
+    def clear(self):
+        with self._lock:
+            self._rooms.clear()
+            self._users.clear()
+
+    def _fresh(self, entry):
+        return entry is not None and time.time() - entry[1] < self.ttl
+
+    def _add(self, room_id, username):
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is not None:
+                room[0][username] = None
+            user = self._users.get(username)
+            if user is not None:
+                user[0].add(room_id)
+
+    def add(self, room_id, username):
+        """Record a join (or a room's creator), call after it is committed."""
+        room_id = int(room_id)
+        self._add(room_id, username)
+        with self._lock:
+            cached = username in self._users
+        if not cached:
+            # the join is committed, so this picks it up too
+            self.rooms_of(username)
+        if self.broker is not None:
+            self.broker.publish('room_members', {'room_id': room_id, 'username': username})
+
+    def is_member(self, room_id, username):
+        try:
+            room_id = int(room_id)
+        except (TypeError, ValueError):
+            return False
+        with self._lock:
+            room = self._rooms.get(room_id)
+            user = self._users.get(username)
+            if (room is not None and username in room[0]) or (user is not None and room_id in user[0]):
+                self.hits += 1
+                return True
+            self.misses += 1
+
+        # the join may have happened on another worker since the user's rooms
+        # were cached, so read them again (their next check costs no SQL)
+        return room_id in self.rooms_of(username, refresh=True)
+
+    def members(self, room_id):
+        """Usernames in a room, in the order they joined."""
+        room_id = int(room_id)
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if self._fresh(room):
+                return list(room[0])
+        c = get_db_connection().cursor()
+        c.execute(_ROOM_MEMBERS, (room_id,))
+        usernames = dict.fromkeys(row[0] for row in c.fetchall())
+        with self._lock:
+            self._rooms[room_id] = (usernames, time.time())
+        return list(usernames)
+
+    def rooms_of(self, username, refresh=False):
+        """Ids of the rooms a user is in, read from the table if refresh is set."""
+        with self._lock:
+            user = self._users.get(username)
+            if not refresh and self._fresh(user):
+                return set(user[0])
+        c = get_db_connection().cursor()
+        c.execute(_USER_ROOMS, (username,))
+        room_ids = {row[0] for row in c.fetchall()}
+        with self._lock:
+            self._users[username] = (room_ids, time.time())
+        return set(room_ids)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'rooms': len(self._rooms),
+                'users': len(self._users),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0
+            }
+
+# per-process membership cache
+membership = MembershipCache()
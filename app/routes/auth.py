@@ -1,10 +1,12 @@
 
 from flask import Blueprint, request, jsonify
-from werkzeug.security import generate_password_hash, check_password_hash
-import uuid
 import sqlite3
-from app.db import get_db_connection
-from app.config import DB_FILE
+from app.db import get_db_connection, close_db
+from app.auth import resolve_token, token_cache
+from app.hashing import hash_password, verify_password, HashingBusy
+from app.sessions import create_session, end_session
+from app.tokens import issue_token, looks_signed, revoke_user_tokens
+from app.config import DB_FILE, AUTH_TOKEN_MODE
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -33,13 +35,24 @@ def register():
         conn.close()
         return jsonify({'error':" the user already exists"}),400
     
-    # hash password
-    hashed_pw = generate_password_hash(password)
+    # hash password, without holding a pooled connection while a worker does it
+    close_db()
+    try:
+        hashed_pw = hash_password(password)
+    except HashingBusy:
+        return jsonify({'error': 'server busy, try again shortly'}), 503
 
-    c.execute('''
-    INSERT INTO users (username,email,avatar_url,description,password)
-              VALUES (?,?,?,?,?)             
-''',(username,email,avatar_url,description,hashed_pw))
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        c.execute('''
+        INSERT INTO users (username,email,avatar_url,description,password)
+                  VALUES (?,?,?,?,?)             
+    ''',(username,email,avatar_url,description,hashed_pw))
+    except sqlite3.IntegrityError:
+        # registered by someone else while we were hashing
+        conn.close()
+        return jsonify({'error':" the user already exists"}),400
     
     # Initialize all stats to 0
     c.execute('''
@@ -70,14 +83,19 @@ def login():
         return jsonify({'error': 'user not found'}), 404
 
     stored_password = row[0]
-    if not check_password_hash(stored_password, password):
-        conn.close()
+    # hand the pooled connection back while a worker checks the password
+    close_db()
+    try:
+        password_ok = verify_password(stored_password, password)
+    except HashingBusy:
+        return jsonify({'error': 'server busy, try again shortly'}), 503
+    if not password_ok:
         return jsonify({'error': 'wrong password'}), 401
 
-    token = str(uuid.uuid4())
-    c.execute('UPDATE users SET token=? WHERE username=?', (token, username))
-    conn.commit()
-    conn.close()
+    if AUTH_TOKEN_MODE == 'signed':
+        return jsonify({'token': issue_token(username), 'username': username}), 200
+
+    token = create_session(username)
 
     return jsonify({'token': token, 'username': username}), 200
 
@@ -89,21 +107,18 @@ def logout():
     if not token:
         return jsonify({'error': 'no token provided'}), 400
 
-    conn = get_db_connection()
-    c = conn.cursor()
-
     # check if token exists
-    c.execute('SELECT username FROM users WHERE token=?', (token,))
-    row = c.fetchone()
-
-    if not row:
-        conn.close()
+    username = resolve_token(token)
+    if not username:
         return jsonify({'error': 'invalid token'}), 401
 
-    # clear token
-    c.execute('UPDATE users SET token=NULL WHERE token=?', (token,))
-    conn.commit()
-    conn.close()
+    if looks_signed(token):
+        revoke_user_tokens(username)
+        return jsonify({'message': 'logged out successfully'}), 200
+
+    # end just this session, other devices stay logged in
+    end_session(token)
+    token_cache.invalidate(token)
 
     return jsonify({'message': 'logged out successfully'}), 200
 
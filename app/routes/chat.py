@@ -1,15 +1,27 @@
 
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, make_response
+import math
 import sqlite3
 import threading
-import time
-from app.db import get_db_connection
-from app.utils import hash_pw, ping_server
-from app.store import messages, save_messages
-from app.config import MAX_MESSAGES, MESSAGE_LIFESPAN
+from app.db import get_db_connection, close_db, hot_query, MAX_INTEGER
+from app.auth import current_user
+from app.utils import hash_pw
+from app.store import room_store
+from app.membership import membership
+from app.sockets import subscribe_user
+from app.config import LONG_POLL_TIMEOUT, LONG_POLL_MAX_WAITERS
 
 chat_bp = Blueprint('chat', __name__)
 
+_USER_ROOMS = hot_query('''SELECT r.id, r.name, r.is_private FROM rooms r
+                           JOIN room_members rm ON r.id = rm.room_id WHERE rm.username=?''', ('u',))
+
+# each parked long-poll holds a worker thread, so cap how many there are
+long_poll_slots = threading.BoundedSemaphore(LONG_POLL_MAX_WAITERS)
+
+def _valid_id(value):
+    return value is None or 0 <= value <= MAX_INTEGER
+
 @chat_bp.route('/api/create_room', methods=['POST'])
 def create_room():
     data = request.get_json()
@@ -25,9 +37,8 @@ def create_room():
     c = conn.cursor()
 
     # validate token
-    c.execute('SELECT username FROM users WHERE token=?', (token,))
-    user = c.fetchone()
-    if not user:
+    username = current_user()
+    if not username:
         conn.close()
         return jsonify({'error': "unauthorized"}), 401
 
@@ -63,9 +74,11 @@ def create_room():
     room_id = c.lastrowid
 
     # add creator to members
-    c.execute('INSERT INTO room_members (room_id, username) VALUES (?, ?)', (room_id, user[0]))
+    c.execute('INSERT INTO room_members (room_id, username) VALUES (?, ?)', (room_id, username))
     conn.commit()
     conn.close()
+    membership.add(room_id, username)
+    subscribe_user(username, room_id)
 
     return jsonify({'message': f'room "{room_name}" created', 'room_id': room_id}), 201
 
@@ -84,9 +97,8 @@ def join_room():
     c = conn.cursor()
 
     # validate token
-    c.execute('SELECT username FROM users WHERE token=?', (token,))
-    user = c.fetchone()
-    if not user:
+    username = current_user()
+    if not username:
         conn.close()
         return jsonify({'error': 'unauthorized'}), 401
 
@@ -112,21 +124,21 @@ def join_room():
     c.execute('''
         INSERT OR REPLACE INTO room_members (room_id, username, joined_at)
         VALUES (?, ?, CURRENT_TIMESTAMP)
-    ''', (room_id, user[0]))
+    ''', (room_id, username))
     
     conn.commit()
     conn.close()
+    membership.add(room_id, username)
+    subscribe_user(username, room_id)
 
     return jsonify({
-        'message': f'{user[0]} joined room "{room_name}"',
+        'message': f'{username} joined room "{room_name}"',
         'room_id': room_id,
         'room_name': room_name
     }), 200
 
 @chat_bp.route('/api/send_room_message', methods=['POST'])
 def send_room_message():
-    ping_thread = threading.Thread(target=ping_server, args=(60,), daemon=True)
-    ping_thread.start()
     data = request.get_json()
     token = request.headers.get('Authorization')
     room_id = data.get('room_id')
@@ -135,34 +147,17 @@ def send_room_message():
     if not token or not room_id or not message:
         return jsonify({'error': 'missing fields'}), 400
 
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('SELECT username FROM users WHERE token=?', (token,))
-    user = c.fetchone()
-    if not user:
-        conn.close()
+    username = current_user()
+    if not username:
         return jsonify({'error': 'unauthorized'}), 401
 
-    c.execute('SELECT id FROM room_members WHERE room_id=? AND username=?', (room_id, user[0]))
-    if not c.fetchone():
-        conn.close()
+    if not membership.is_member(room_id, username):
         return jsonify({'error': 'you are not in this room'}), 403
-    
-    conn.close()
-
-    message_data = {
-        'username': user[0],
-        'message': message,
-        'created_at': time.time(),
-        'room_id': room_id
-    }
 
-    messages.append(message_data)
-    now = time.time()
-    messages[:] = [m for m in messages if now - m['created_at'] < MESSAGE_LIFESPAN]
-    if len(messages) > MAX_MESSAGES:
-        messages.pop(0)
-    save_messages(messages)
+    try:
+        room_store.append(room_id, username, message)
+    except RuntimeError:
+        return jsonify({'error': 'could not store message, try again'}), 503
 
     return jsonify({'message': 'sent'}), 200
 
@@ -170,27 +165,76 @@ def send_room_message():
 def get_room_messages():
     token = request.headers.get('Authorization')
     room_id = request.args.get('room_id')
+    # only return messages newer than this id (the last one the client has)
+    after_id = request.args.get('after_id', type=int) or request.args.get('since', 0, type=int)
+    # page further back in history with the oldest id the client has
+    before_id = request.args.get('before_id', type=int)
+    limit = request.args.get('limit', type=int)
 
     if not token or not room_id:
         return jsonify({'error': 'missing token or room id'}), 400
+    if not (_valid_id(after_id) and _valid_id(before_id)):
+        return jsonify({'error': 'invalid message id'}), 400
 
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('SELECT username FROM users WHERE token=?', (token,))
-    user = c.fetchone()
-    if not user:
-        conn.close()
+    username = current_user()
+    if not username:
         return jsonify({'error': 'unauthorized'}), 401
 
-    c.execute('SELECT id FROM room_members WHERE room_id=? AND username=?', (room_id, user[0]))
-    if not c.fetchone():
-        conn.close()
+    if not membership.is_member(room_id, username):
         return jsonify({'error': 'you are not in this room'}), 403
-    
-    conn.close()
 
-    filtered = [m for m in messages if str(m.get('room_id')) == str(room_id)]
-    return jsonify({'messages': filtered}), 200
+    # idle polls are answered from the etag alone, nothing gets serialized
+    etag = room_store.etag(room_id)
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+
+    # the body comes pre-encoded, shared with every other reader of this page
+    body, etag = room_store.get_encoded(room_id, after_id, before_id, limit)
+    response = make_response(body)
+    response.mimetype = 'application/json'
+    response.set_etag(etag)
+    return response, 200
+
+@chat_bp.route('/api/wait_room_messages', methods=['GET'])
+def wait_room_messages():
+    token = request.headers.get('Authorization')
+    room_id = request.args.get('room_id')
+    after_id = request.args.get('after_id', 0, type=int)
+    timeout = request.args.get('timeout', LONG_POLL_TIMEOUT, type=float)
+    if not math.isfinite(timeout):
+        return jsonify({'error': 'invalid timeout'}), 400
+    timeout = min(timeout, LONG_POLL_TIMEOUT)
+
+    if not token or not room_id:
+        return jsonify({'error': 'missing token or room id'}), 400
+    if not _valid_id(after_id):
+        return jsonify({'error': 'invalid message id'}), 400
+
+    username = current_user()
+    if not username:
+        return jsonify({'error': 'unauthorized'}), 401
+
+    if not membership.is_member(room_id, username):
+        return jsonify({'error': 'you are not in this room'}), 403
+
+    # hand the connection back to the pool (if the checks took one) before parking
+    close_db()
+
+    if not long_poll_slots.acquire(blocking=False):
+        return jsonify({'error': 'too many waiting clients, poll get_room_messages instead'}), 503
+    try:
+        room_store.wait(room_id, after_id, max(timeout, 0))
+    finally:
+        long_poll_slots.release()
+
+    # everyone woken by the same send gets the same cached body
+    body, etag = room_store.get_encoded(room_id, after_id)
+    response = make_response(body)
+    response.mimetype = 'application/json'
+    response.set_etag(etag)
+    return response, 200
 
 @chat_bp.route('/api/rooms', methods=['GET'])
 def list_rooms():
@@ -200,20 +244,18 @@ def list_rooms():
 
     conn = get_db_connection()
     c = conn.cursor()
-    c.execute('SELECT username FROM users WHERE token=?', (token,))
-    user = c.fetchone()
-    if not user:
+    username = current_user()
+    if not username:
         conn.close()
         return jsonify({'error': 'unauthorized'}), 401
 
     c.execute('SELECT id, name FROM rooms WHERE is_private=0')
     rooms = c.fetchall()
 
-    c.execute('SELECT room_id FROM room_members WHERE username=?', (user[0],))
-    user_rooms_set = {r[0] for r in c.fetchall()}
-
     conn.close()
 
+    user_rooms_set = membership.rooms_of(username)
+
     data = []
     for room_id, name in rooms:
         data.append({
@@ -230,23 +272,14 @@ def get_room_members(room_id):
     if not token:
         return jsonify({'error': 'invalid token, please re-login'}), 401
     
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('SELECT username FROM users WHERE token=?', (token,))
-    user = c.fetchone()
-    if not user:
-        conn.close()
+    username = current_user()
+    if not username:
         return jsonify({'error': 'unauthorized'}), 401
     
-    c.execute('SELECT username FROM room_members WHERE room_id=?', (room_id,))
-    members = c.fetchall()
-    if not members:
-        conn.close()
+    members_list = membership.members(room_id)
+    if not members_list:
         return jsonify({'error': 'no members in this room'}), 404
     
-    members_list = [m[0] for m in members]
-    conn.close()
-    
     return jsonify({'members': members_list}), 200
 
 @chat_bp.route('/api/user_rooms', methods=['GET'])
@@ -257,16 +290,13 @@ def user_rooms():
     
     conn = get_db_connection()
     c = conn.cursor()
-    c.execute('SELECT username FROM users WHERE token=?', (token,))
-    user = c.fetchone()
-    if not user:
+    username = current_user()
+    if not username:
         conn.close()
         return jsonify({'error': 'unauthorized'}), 401
     
-    username = user[0]
-    
     # Get all rooms the user is a member of
-    c.execute('SELECT r.id, r.name, r.is_private FROM rooms r JOIN room_members rm ON r.id = rm.room_id WHERE rm.username=?', (username,))
+    c.execute(_USER_ROOMS, (username,))
     rooms = c.fetchall()
     conn.close()
     
@@ -1,118 +1,194 @@
-
 from flask import Blueprint, request, jsonify
 import sqlite3
 import random
 import re
-from collections import Counter
-from app.db import get_db_connection
+import json
+import base64
+import binascii
+from app.db import get_db_connection, hot_query, MAX_INTEGER
+from app.auth import current_user
+from app.sessions import hash_token
+from app.config import FEED_TIMELINE_POSTS, FEED_GLOBAL_POSTS, FEED_ARCHIVE_POSTS, HASHTAG_PAGE_SIZE
+from app.timeline import read_home_timeline
+from app.trending import trending, normalize_hashtag
 
 feed_bp = Blueprint('feed', __name__)
 
+# The feed is paged with an opaque cursor holding where each part of it
+# stopped, plus the shuffle seed:
+#   [timeline score, timeline post id, lowest global id, highest archive id, seed]
+# Global posts are read newest first and archive posts oldest first, each
+# stopping at the other's position, so together they never repeat a post.
+# Both leave out followed accounts, whose posts come through the timeline
+# part, so no post shows up twice while scrolling.
+# The seed comes from the session token, and a page is shuffled with the
+# seed and its cursor, so the same cursor always gives the same page.
+
+_NOT_FOLLOWED = 'username NOT IN (SELECT following FROM following WHERE follower=?)'
+
+_GLOBAL_POSTS = hot_query(f'''SELECT id, username, content, created_at, upvotes, downvotes FROM posts
+                              WHERE id < ? AND id > ? AND {_NOT_FOLLOWED} ORDER BY id DESC LIMIT ?''',
+                          (0, 0, 'u', 12))
+_ARCHIVE_POSTS = hot_query(f'''SELECT id, username, content, created_at, upvotes, downvotes FROM posts
+                               WHERE id > ? AND id < ? AND {_NOT_FOLLOWED} ORDER BY id LIMIT ?''',
+                           (0, 0, 'u', 6))
+_HASHTAG_POSTS = hot_query('''SELECT p.id, p.username, p.content, p.created_at, p.upvotes, p.downvotes
+                              FROM post_hashtags h JOIN posts p ON p.id = h.post_id
+                              WHERE h.tag=? AND (h.created_at, h.post_id) < (?, ?)
+                              ORDER BY h.created_at DESC, h.post_id DESC LIMIT ?''', ('t', '9999', 0, 20))
+
+def _encode_cursor(cursor):
+    return base64.urlsafe_b64encode(json.dumps(cursor, separators=(',', ':')).encode()).decode().rstrip('=')
+
+def _decode_cursor(value, valid):
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)))
+    except (binascii.Error, ValueError):
+        return None
+    if not (isinstance(cursor, list) and valid(cursor)):
+        return None
+    return cursor
+
+def _cursor_int(value):
+    # bool is an int too, and sqlite cannot take anything past 64 bits
+    return type(value) is int and 0 <= value <= MAX_INTEGER
+
+def _valid_fyp_cursor(cursor):
+    return (len(cursor) == 5 and all(v is None or _cursor_int(v) for v in cursor[:3])
+            and _cursor_int(cursor[3]) and _cursor_int(cursor[4])
+            and (cursor[0] is None) == (cursor[1] is None))
+
+# posts.created_at as sqlite writes it
+_TIMESTAMP = re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}')
+
+def _valid_hashtag_cursor(cursor):
+    return (len(cursor) == 2 and isinstance(cursor[0], str) and _TIMESTAMP.fullmatch(cursor[0]) is not None
+            and _cursor_int(cursor[1]))
+
+def _post_data(row):
+    return {
+        'id': row[0],
+        'username': row[1],
+        'content': row[2],
+        'created_at': row[3],
+        'upvotes': row[4],
+        'downvotes': row[5]
+    }
+
 @feed_bp.route('/api/fyp',methods=['GET'])
 def fyp():
     token = request.headers.get('Authorization')
     if not token:
         return jsonify({'error':'invalid token , please login again'}),401
+
+    cursor_arg = request.args.get('cursor')
+    if cursor_arg:
+        cursor = _decode_cursor(cursor_arg, _valid_fyp_cursor)
+        if cursor is None:
+            return jsonify({'error':'invalid cursor'}),400
+    else:
+        cursor = [None, None, None, 0, int(hash_token(token)[:8], 16)]
+    timeline_score, timeline_id, global_before, archive_after, seed = cursor
+    if global_before is None:
+        global_before = 2 ** 62
     
     conn = get_db_connection()
     c = conn.cursor()
-    c.execute('SELECT username FROM users WHERE token=?',(token,))
-    user = c.fetchone()
-    if not user:
+    username = current_user()
+    if not username:
         conn.close()
         return jsonify({'error':'unauthorized'}),401
-    username = user[0]
     
-    followed_users = []
-    c.execute('SELECT following FROM following WHERE follower=?',(username,))
-    followed = c.fetchall()
-    if followed:
-        followed_users = [f[0] for f in followed]
-    else:
-        conn.close()
-        return jsonify({'message':'no users being followed , yet'}),200
-    
-    # Get recent posts from followed users
-    recent_posts = []
-    # format replacement is necessary for IN clause with dynamic list
-    placeholders = ','.join(['?'] * len(followed_users))
-    query = 'SELECT id, username, content, created_at, upvotes, downvotes FROM posts WHERE username IN ({}) ORDER BY created_at DESC LIMIT 20'.format(placeholders)
-    c.execute(query, followed_users)
-    recent_posts = c.fetchall()
-    
-    if not recent_posts:
+    # posts of followed accounts, pushed or pulled by app/timeline.py
+    timeline_before = (timeline_score, timeline_id) if timeline_score is not None else None
+    timeline_rows = read_home_timeline(c, username, FEED_TIMELINE_POSTS, timeline_before)
+    recent_posts = [row[1:] for row in timeline_rows]
+
+    if not recent_posts and not cursor_arg:
+        c.execute('SELECT 1 FROM following WHERE follower=? LIMIT 1', (username,))
+        following_anyone = c.fetchone()
         conn.close()
+        if not following_anyone:
+            return jsonify({'message':'no users being followed , yet'}),200
         return jsonify({'message':'no recent posts from followed users'}),200
     
-    recent_posts_data = []
-    for row in recent_posts:
-        post_data = {
-            'id': row[0],
-            'username': row[1],
-            'content': row[2],
-            'created_at': row[3],
-            'upvotes': row[4],
-            'downvotes': row[5]
-        }
-        recent_posts_data.append(post_data)
+    recent_posts_data = [_post_data(row) for row in recent_posts]
         
-    # Get global posts (not from followed users)
-    global_posts = []
-    query_global = 'SELECT id, username, content, created_at, upvotes, downvotes FROM posts WHERE username NOT IN ({}) ORDER BY created_at DESC LIMIT 20'.format(placeholders)
-    c.execute(query_global, followed_users)
-    global_posts = c.fetchall()
-    
-    global_posts_data = []
-    for row in global_posts:
-        post_data = {
-            'id': row[0],
-            'username': row[1],
-            'content': row[2],
-            'created_at': row[3],
-            'upvotes': row[4],
-            'downvotes': row[5]
-        }
-        global_posts_data.append(post_data)
+    # Get global posts (newest overall from accounts not followed; the
+    # timeline check covers a follow made while scrolling)
+    timeline_ids = {row[0] for row in recent_posts}
+    c.execute(_GLOBAL_POSTS, (global_before, archive_after, username, FEED_GLOBAL_POSTS))
+    global_rows = c.fetchall()
+    global_posts = [row for row in global_rows if row[0] not in timeline_ids]
+    global_posts_data = [_post_data(row) for row in global_posts]
         
-    # Get old/random posts (from the last 100 posts)
-    old_posts = []
-    c.execute('SELECT id, username, content, created_at, upvotes, downvotes FROM posts ORDER BY created_at ASC LIMIT 100')
-    old_posts = c.fetchall()
-    
-    old_posts_data = []
-    for row in old_posts:
-        post_data = {
-            'id': row[0],
-            'username': row[1],
-            'content': row[2],
-            'created_at': row[3],
-            'upvotes': row[4],
-            'downvotes': row[5]
-        }
-        old_posts_data.append(post_data)
+    # Get old posts (oldest first, up to where the global part has got to)
+    c.execute(_ARCHIVE_POSTS, (archive_after, global_before, username, FEED_ARCHIVE_POSTS))
+    old_rows = c.fetchall()
+    seen_ids = timeline_ids | {row[0] for row in global_posts}
+    old_posts_data = [_post_data(row) for row in old_rows if row[0] not in seen_ids]
     
     conn.close()
-    
-    # Combine and shuffle the posts
+
+    next_cursor = None
+    if (len(timeline_rows) == FEED_TIMELINE_POSTS or len(global_rows) == FEED_GLOBAL_POSTS
+            or len(old_rows) == FEED_ARCHIVE_POSTS):
+        if timeline_rows:
+            timeline_score, timeline_id = timeline_rows[-1][0], timeline_rows[-1][1]
+        next_cursor = _encode_cursor([
+            timeline_score, timeline_id,
+            global_rows[-1][0] if global_rows else global_before,
+            old_rows[-1][0] if old_rows else archive_after,
+            seed
+        ])
+
+    # Combine and shuffle the posts, the same way every time for this page
     combined_posts = recent_posts_data + global_posts_data + old_posts_data
-    random.shuffle(combined_posts)
+    random.Random(f'{seed}:{cursor_arg or ""}').shuffle(combined_posts)
     
-    # Limit to 30 posts
-    combined_posts = combined_posts[:30]
+    # top 3 of the precomputed trending hashtags
+    trending_topics = [f'#{tag}' for tag, score, uses in trending.top()[:3]]
     
-    # Extract hashtags from recent global posts
-    hashtags = []
-    for post in global_posts_data:
-        if 'content' in post:
-            found_hashtags = re.findall(r'#(\w+)', post['content'])
-            hashtags.extend(found_hashtags)
-            
-    # Get top 3 trending hashtags
-    hashtag_counts = Counter(hashtags)
-    trending_hashtags = hashtag_counts.most_common(3)
-    trending_topics = [f'#{tag}' for tag, count in trending_hashtags]
-    
-    return jsonify({
+    response = jsonify({
         'posts': combined_posts,
-        'trending_topics': trending_topics
-    }), 200
+        'trending_topics': trending_topics,
+        'next_cursor': next_cursor
+    })
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.add_etag()
+    return response.make_conditional(request)
+
+@feed_bp.route('/api/trending',methods=['GET'])
+def trending_hashtags():
+    return jsonify({'trending': [{'tag': f'#{tag}', 'score': score, 'uses': uses}
+                                 for tag, score, uses in trending.top()]}),200
+
+@feed_bp.route('/api/hashtag/<tag>',methods=['GET'])
+def hashtag_posts(tag):
+    tag = normalize_hashtag(tag)
+    if not tag:
+        return jsonify({'error':'invalid hashtag'}),400
+
+    # newest first, the cursor is the (created_at, id) of the last post shown
+    cursor_arg = request.args.get('cursor')
+    if cursor_arg:
+        cursor = _decode_cursor(cursor_arg, _valid_hashtag_cursor)
+        if cursor is None:
+            return jsonify({'error':'invalid cursor'}),400
+    else:
+        cursor = ['9999-12-31 23:59:59', 0]
+
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute(_HASHTAG_POSTS, (tag, cursor[0], cursor[1], HASHTAG_PAGE_SIZE))
+    rows = c.fetchall()
+    conn.close()
+
+    next_cursor = None
+    if len(rows) == HASHTAG_PAGE_SIZE:
+        next_cursor = _encode_cursor([rows[-1][3], rows[-1][0]])
+    return jsonify({
+        'tag': f'#{tag}',
+        'posts': [_post_data(row) for row in rows],
+        'next_cursor': next_cursor
+    }),200
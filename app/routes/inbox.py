@@ -1,10 +1,17 @@
 
 from flask import Blueprint, request, jsonify
 from typing import Any
-from app.db import get_db_connection
+from app.db import get_db_connection, hot_query
+from app.auth import current_user
 
 inbox_bp = Blueprint('inbox', __name__)
 
+_INBOX = hot_query('''SELECT im.id, im.sender, im.recipient, im.message, im.created_at,
+                             u.avatar_url AS sender_avatar
+                      FROM inbox_messages im LEFT JOIN users u ON im.sender = u.username
+                      WHERE im.recipient=? OR im.sender=? ORDER BY im.created_at DESC''', ('u', 'u'))
+_INBOX_COUNT = hot_query('SELECT COUNT(*) FROM inbox_messages WHERE recipient=? OR sender=?', ('u', 'u'))
+
 @inbox_bp.route('/api/send_inbox_message',methods=['POST'])
 def send_inbox_message():
     data = request.get_json()
@@ -20,12 +27,10 @@ def send_inbox_message():
     
     conn = get_db_connection()
     c = conn.cursor()
-    c.execute('SELECT username FROM users WHERE token=?',(token,))
-    user = c.fetchone()
-    if not user:
+    sender = current_user()
+    if not sender:
         conn.close()
         return jsonify({'error':'unauthorized'}),401
-    sender = user[0]
     
     c.execute('SELECT username FROM users WHERE username=?',(recipient_username,))
     recipient = c.fetchone()
@@ -50,22 +55,13 @@ def inbox():
     
     conn = get_db_connection()
     c = conn.cursor()
-    c.execute('SELECT username FROM users WHERE token=?', (token,))
-    user = c.fetchone()
-    if not user:
+    username = current_user()
+    if not username:
         conn.close()
         return jsonify({'error': 'unauthorized'}), 401
-    username = user[0]
     
     # Corrected query to get sender's avatar
-    c.execute('''
-        SELECT im.id, im.sender, im.recipient, im.message, im.created_at,
-               u.avatar_url AS sender_avatar
-        FROM inbox_messages im
-        LEFT JOIN users u ON im.sender = u.username
-        WHERE im.recipient=? OR im.sender=?
-        ORDER BY im.created_at DESC
-    ''', (username, username))
+    c.execute(_INBOX, (username, username))
     
     messages_rows = c.fetchall()
     conn.close()
@@ -97,15 +93,12 @@ def delete_inbox_message():
 
     conn = get_db_connection()
     c = conn.cursor()
-    c.execute('SELECT username FROM users WHERE token=?', (token,))
-    user = c.fetchone()
+    username = current_user()
     
-    if not user:
+    if not username:
         conn.close()
         return jsonify({'error': 'unauthorized'}), 401
     
-    username = user[0]
-    
     # Check if the message exists and belongs to the user (either as sender or recipient)
     c.execute('SELECT * FROM inbox_messages WHERE id=? AND (recipient=? OR sender=?)', (message_id, username, username))
     msg = c.fetchone()
@@ -132,16 +125,13 @@ def inbox_count():
     
     conn = get_db_connection()
     c = conn.cursor()
-    c.execute('SELECT username FROM users WHERE token=?', (token,))
-    user = c.fetchone()
+    username = current_user()
     
-    if not user:
+    if not username:
         conn.close()
         return jsonify({'error': 'unauthorized'}), 401
     
-    username = user[0]
-    
-    c.execute('SELECT COUNT(*) FROM inbox_messages WHERE recipient=? OR sender=?', (username, username))
+    c.execute(_INBOX_COUNT, (username, username))
     count = c.fetchone()[0]
     
     conn.close()
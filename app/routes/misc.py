@@ -1,8 +1,40 @@
 
 from flask import Blueprint, jsonify
+from app.auth import token_cache, current_user
+from app import hashing
+from app.scheduler import scheduler
+from app.store import room_store
+from app.membership import membership
+from app.trending import trending
 
 misc_bp = Blueprint('misc', __name__)
 
 @misc_bp.route('/api/ping', methods=['GET'])
 def ping():
     return jsonify({'message': 'pong'}), 200
+
+@misc_bp.route('/api/stats', methods=['GET'])
+def stats():
+    if not current_user():
+        return jsonify({'error': 'unauthorized'}), 401
+    return jsonify({
+        'auth_cache': token_cache.stats(),
+        'password_hashing': hashing.stats(),
+        'broker': room_store.broker.stats() if room_store.broker is not None else None,
+        'room_membership': membership.stats(),
+        'trending': trending.stats()
+    }), 200
+
+@misc_bp.route('/api/scheduler/jobs', methods=['GET'])
+def scheduler_jobs():
+    return jsonify({'jobs': scheduler.jobs()}), 200
+
+@misc_bp.route('/api/stats/rooms', methods=['GET'])
+def room_usage():
+    username = current_user()
+    if not username:
+        return jsonify({'error': 'unauthorized'}), 401
+    # private rooms only show up for their members
+    mine = membership.rooms_of(username)
+    rooms = [room for room in room_store.usage() if not room['is_private'] or room['room_id'] in mine]
+    return jsonify({'rooms': rooms}), 200
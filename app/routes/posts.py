@@ -1,10 +1,19 @@
 
 from flask import Blueprint, request, jsonify
 import sqlite3
-from app.db import get_db_connection
+from app.db import get_db_connection, hot_query
+from app.auth import current_user
+from app.timeline import fan_out_post
+from app.trending import trending, extract_hashtags
 
 posts_bp = Blueprint('posts', __name__)
 
+_USER_POSTS = hot_query('''SELECT id, username, content, created_at, upvotes, downvotes FROM posts
+                           WHERE username=? ORDER BY created_at DESC''', ('u',))
+_POST_REPLIES = hot_query('''SELECT r.id, r.username, r.content, r.created_at, u.avatar_url
+                             FROM replies r JOIN users u ON r.username = u.username
+                             WHERE r.post_id=? ORDER BY r.created_at DESC''', (1,))
+
 @posts_bp.route('/api/create_post',methods=['POST'])
 def create_post():
     data = request.get_json()
@@ -22,21 +31,29 @@ def create_post():
     
     conn = get_db_connection()
     c = conn.cursor()
-    c.execute('SELECT username FROM users WHERE token=?',(token,))
-    user = c.fetchone()
-    if not user:
+    username = current_user()
+    if not username:
         conn.close()
         return jsonify({'error':'unauthorized'}),401
-    username = user[0]
     
     c.execute('INSERT INTO posts (username,content) VALUES (?,?)',(username,content))
+    post_id = c.lastrowid
+
+    tags = extract_hashtags(content)
+    c.executemany('''INSERT OR IGNORE INTO post_hashtags (post_id, tag, created_at)
+                     SELECT id, ?, created_at FROM posts WHERE id=?''', [(tag, post_id) for tag in tags])
     
     # Update user's post count
     c.execute('UPDATE user_profile SET posts = posts + 1 WHERE username=?', (username,))
 
     conn.commit()
-    post_id = c.lastrowid
     conn.close()
+    fan_out_post(post_id)
+    try:
+        trending.add(tags)
+    except Exception as e:
+        # the post is saved, the counts catch up when the window is reloaded
+        print(f"Trending update failed: {e}")
     return jsonify({'message':'post created'}),201
 
 
@@ -44,7 +61,7 @@ def create_post():
 def get_posts(username):
     conn = get_db_connection()
     c = conn.cursor()
-    c.execute('SELECT id, username, content, created_at, upvotes, downvotes FROM posts WHERE username=? ORDER BY created_at DESC',(username,))
+    c.execute(_USER_POSTS, (username,))
     rows = c.fetchall()
     conn.close()
     
@@ -79,12 +96,10 @@ def vote_post():
     
     conn = get_db_connection()
     c = conn.cursor()
-    c.execute('SELECT username FROM users WHERE token=?',(token,))
-    user = c.fetchone()
-    if not user:
+    username = current_user()
+    if not username:
         conn.close()
         return jsonify({'error':'unauthorized'}),401
-    username = user[0]
     
     # check if post exists
     c.execute('SELECT username FROM posts WHERE id=?',(post_id,))
@@ -154,13 +169,11 @@ def reply_to_post():
     
     conn = get_db_connection()
     c = conn.cursor()
-    c.execute('SELECT username FROM users WHERE token=?', (token,))
-    user = c.fetchone()
+    username = current_user()
     
-    if not user:
+    if not username:
         conn.close()
         return jsonify({'error': 'unauthorized'}), 401
-    username = user[0]
     
     # Check if post exists
     c.execute('SELECT id FROM posts WHERE id=?', (post_id,))
@@ -193,13 +206,7 @@ def get_replies(post_id):
         return jsonify({'error': 'post not found'}), 404
     
     # Get replies for the post
-    c.execute('''
-        SELECT r.id, r.username, r.content, r.created_at, u.avatar_url 
-        FROM replies r
-        JOIN users u ON r.username = u.username
-        WHERE r.post_id=?
-        ORDER BY r.created_at DESC
-    ''', (post_id,))
+    c.execute(_POST_REPLIES, (post_id,))
     
     replies = []
     for row in c.fetchall():
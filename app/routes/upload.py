@@ -2,11 +2,10 @@
 from flask import Blueprint, request, jsonify
 from flask_cors import cross_origin
 import sqlite3
-import time
-from app.db import get_db_connection
+from app.auth import current_user
 from app.utils import file_uploader
-from app.store import messages, save_messages
-from app.config import MAX_MESSAGES, MESSAGE_LIFESPAN
+from app.store import room_store
+from app.membership import membership
 
 upload_bp = Blueprint('upload', __name__)
 
@@ -41,37 +40,17 @@ def upload_file():
             print(f"File upload failed: {str(e)}")
             return jsonify({'error': f'File upload failed: {str(e)}'}), 500
         
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute('SELECT username FROM users WHERE token=?', (token,))
-        user = c.fetchone()
-        if not user:
-            conn.close()
+        username = current_user()
+        if not username:
             return jsonify({'error': 'Unauthorized access'}), 401
-        username = user[0]
         
-        c.execute('SELECT id FROM room_members WHERE room_id=? AND username=?', (room_id, username))
-        if not c.fetchone():
-            conn.close()
+        if not membership.is_member(room_id, username):
             return jsonify({'error': 'You are not a member of this room'}), 403
-        
-        conn.close()
 
-        message_data = {
-            'username': username,
-            'message': f'{file_url}',
-            'created_at': time.time(),
-            'room_id': room_id
-        }
-        messages.append(message_data)
-        
-        now = time.time()
-        messages[:] = [m for m in messages if now - m['created_at'] < MESSAGE_LIFESPAN]
-        
-        if len(messages) > MAX_MESSAGES:
-            messages.pop(0)
-        
-        save_messages(messages)
+        try:
+            room_store.append(room_id, username, f'{file_url}')
+        except RuntimeError:
+            return jsonify({'error': 'could not store message, try again'}), 503
             
         return jsonify({
             'message': 'File uploaded successfully',
@@ -1,11 +1,19 @@
 
 from flask import Blueprint, request, jsonify
-from werkzeug.security import generate_password_hash
 import sqlite3
-from app.db import get_db_connection
+from app.db import get_db_connection, close_db, hot_query
+from app.auth import current_user
+from app.hashing import hash_password, HashingBusy
+from app.timeline import backfill_follow, remove_follow, push_unpulled_authors
 
 users_bp = Blueprint('users', __name__)
 
+_IS_FOLLOWING = hot_query('SELECT * FROM following WHERE follower=? AND following=?', ('u', 'v'))
+_FOLLOWERS = hot_query('''SELECT u.username, u.avatar_url FROM following f JOIN users u ON f.follower = u.username
+                          WHERE f.following = ? ORDER BY f.created_at DESC''', ('u',))
+_FOLLOWING = hot_query('''SELECT u.username, u.avatar_url FROM following f JOIN users u ON f.following = u.username
+                          WHERE f.follower = ? ORDER BY f.created_at DESC''', ('u',))
+
 @users_bp.route('/api/user/settings', methods=['POST'])
 def update_settings():
     token = request.headers.get('Authorization')
@@ -20,17 +28,22 @@ def update_settings():
     custom_css = data.get('custom_css')
     background_image = data.get('background_image')
 
-    conn = get_db_connection()
-    c = conn.cursor()
-
     # Get user by token
-    c.execute('SELECT username FROM users WHERE token=?', (token,))
-    user = c.fetchone()
-    if not user:
-        conn.close()
+    username = current_user()
+    if not username:
         return jsonify({'error': 'unauthorized'}), 401
-    
-    username = user[0]
+
+    hashed_pw = None
+    if password:
+        # hand the pooled connection back while a worker hashes
+        close_db()
+        try:
+            hashed_pw = hash_password(password)
+        except HashingBusy:
+            return jsonify({'error': 'server busy, try again shortly'}), 503
+
+    conn = get_db_connection()
+    c = conn.cursor()
 
     # Dynamically build update query
     updates = []
@@ -45,9 +58,9 @@ def update_settings():
     if description is not None:
         updates.append("description = ?")
         params.append(description)
-    if password:
+    if hashed_pw:
         updates.append("password = ?")
-        params.append(generate_password_hash(password))
+        params.append(hashed_pw)
     if custom_css is not None:
         updates.append("custom_css = ?")
         params.append(custom_css)
@@ -126,12 +139,10 @@ def follow_user():
     c = conn.cursor()
 
     # Get current user
-    c.execute('SELECT username FROM users WHERE token=?', (token,))
-    user = c.fetchone()
-    if not user:
+    username = current_user()
+    if not username:
         conn.close()
         return jsonify({'error': 'unauthorized'}), 401
-    username = user[0]
 
     # Check if target exists
     c.execute('SELECT username FROM users WHERE username=?', (target_username,))
@@ -140,7 +151,7 @@ def follow_user():
         return jsonify({'error': 'user not found'}), 404
 
     # Check if already following
-    c.execute('SELECT * FROM following WHERE follower=? AND following=?', (username, target_username))
+    c.execute(_IS_FOLLOWING, (username, target_username))
     if c.fetchone():
         conn.close()
         return jsonify({'error': 'already following'}), 400
@@ -154,6 +165,7 @@ def follow_user():
 
     conn.commit()
     conn.close()
+    backfill_follow(username, target_username)
     return jsonify({'message': f'now following {target_username}'}), 200
 
 @users_bp.route('/api/unfollow', methods=['POST'])
@@ -169,12 +181,10 @@ def unfollow_user():
     c = conn.cursor()
 
     # Get current user
-    c.execute('SELECT username FROM users WHERE token=?', (token,))
-    user = c.fetchone()
-    if not user:
+    username = current_user()
+    if not username:
         conn.close()
         return jsonify({'error': 'unauthorized'}), 401
-    username = user[0]
 
     # Remove follow relationship
     c.execute('DELETE FROM following WHERE follower=? AND following=?', (username, target_username))
@@ -189,6 +199,9 @@ def unfollow_user():
 
     conn.commit()
     conn.close()
+    remove_follow(username, target_username)
+    # if that took them below the pull threshold, push what they posted meanwhile
+    push_unpulled_authors(target_username)
     return jsonify({'message': f'unfollowed {target_username}'}), 200
 
 @users_bp.route('/api/check_follow', methods=['GET'])
@@ -203,15 +216,13 @@ def check_follow():
     c = conn.cursor()
 
     # Get current user
-    c.execute('SELECT username FROM users WHERE token=?', (token,))
-    user = c.fetchone()
-    if not user:
+    username = current_user()
+    if not username:
         conn.close()
         return jsonify({'error': 'unauthorized'}), 401
-    username = user[0]
 
     # Check if following
-    c.execute('SELECT * FROM following WHERE follower=? AND following=?', (username, target_username))
+    c.execute(_IS_FOLLOWING, (username, target_username))
     is_following = bool(c.fetchone())
 
     conn.close()
@@ -230,13 +241,7 @@ def get_followers(username):
         return jsonify({'error': 'user not found'}), 404
     
     # Get followers with their avatars
-    c.execute('''
-        SELECT u.username, u.avatar_url 
-        FROM following f
-        JOIN users u ON f.follower = u.username
-        WHERE f.following = ?
-        ORDER BY f.created_at DESC
-    ''', (username,))
+    c.execute(_FOLLOWERS, (username,))
     
     followers = [{'username': row[0], 'avatar_url': row[1] or 'default.png'} for row in c.fetchall()]
     conn.close()
@@ -255,13 +260,7 @@ def get_following(username):
         return jsonify({'error': 'user not found'}), 404
     
     # Get following with their avatars
-    c.execute('''
-        SELECT u.username, u.avatar_url 
-        FROM following f
-        JOIN users u ON f.following = u.username
-        WHERE f.follower = ?
-        ORDER BY f.created_at DESC
-    ''', (username,))
+    c.execute(_FOLLOWING, (username,))
     
     following = [{'username': row[0], 'avatar_url': row[1] or 'default.png'} for row in c.fetchall()]
     conn.close()
@@ -0,0 +1,111 @@
+import atexit
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from app.config import SCHEDULER_WORKERS, SCHEDULER_JITTER
+
+# One background scheduler per process for the periodic housekeeping
+# jobs (keepalive ping, chat expiry, session sweeps, stats...). A single
+# dispatcher thread sleeps until the next job is due and hands it to a
+# small thread pool; a job never overlaps with its own previous run.
+
+class Job:
+
+    def __init__(self, name, interval, fn, run_now):
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self.next_run = time.time() if run_now else time.time() + interval
+        self.last_run = None
+        self.last_duration = None
+        self.last_error = None
+        self.runs = 0
+        self.running = False
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'interval': self.interval,
+            'running': self.running,
+            'runs': self.runs,
+            'last_run': self.last_run,
+            'last_duration': round(self.last_duration, 4) if self.last_duration is not None else None,
+            'last_error': self.last_error,
+            'next_run': self.next_run
+        }
+
+class Scheduler:
+
+    def __init__(self, workers=SCHEDULER_WORKERS, jitter=SCHEDULER_JITTER):
+        self.workers = workers
+        self.jitter = jitter
+        self._jobs = {}
+        self._cond = threading.Condition()
+        self._executor = None
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+
+    def add_job(self, name, interval, fn, run_now=True):
+        """Register a periodic job; a second job with the same name is ignored."""
+        with self._cond:
+            if name not in self._jobs:
+                self._jobs[name] = Job(name, interval, fn, run_now)
+                self._cond.notify()
+
+    def start(self):
+        """Start the dispatcher, at most once per process (also after a fork)."""
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopping = False
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='scheduler-job')
+            self._thread = threading.Thread(target=self._loop, name='scheduler', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def jobs(self):
+        with self._cond:
+            return [job.to_dict() for job in self._jobs.values()]
+
+    def _loop(self):
+        with self._cond:
+            while not self._stopping:
+                now = time.time()
+                for job in self._jobs.values():
+                    if job.next_run <= now and not job.running:
+                        job.running = True
+                        self._executor.submit(self._run, job)
+                pending = [job.next_run for job in self._jobs.values() if not job.running]
+                timeout = max(min(pending) - now, 0.01) if pending else None
+                self._cond.wait(timeout)
+
+    def _run(self, job):
+        started = time.time()
+        error = None
+        try:
+            job.fn()
+        except Exception as e:
+            error = str(e)
+            print(f'Job {job.name} failed: {e}')
+        with self._cond:
+            job.running = False
+            job.runs += 1
+            job.last_run = started
+            job.last_duration = time.time() - started
+            job.last_error = error
+            # spread jobs out so workers started together don't fire in lockstep
+            job.next_run = started + job.interval * (1 + random.uniform(-self.jitter, self.jitter))
+            self._cond.notify()
+
+scheduler = Scheduler()
@@ -0,0 +1,86 @@
+import hashlib
+import threading
+import time
+import uuid
+from app.db import connect, get_db_connection, hot_query
+from app.config import SESSION_TTL
+
+# Opaque login sessions. Only a SHA-256 of the token is stored, one row
+# per login, so a user can stay signed in on several devices. last_seen
+# (and with it the sliding expiry) is buffered in memory and written in
+# batches by flush_last_seen() instead of one UPDATE per request.
+
+_LOOKUP = hot_query('SELECT username, expires_at FROM sessions WHERE token_hash=?', ('h',))
+_SWEEP = hot_query('DELETE FROM sessions WHERE expires_at < ?', (0,))
+
+_last_seen = {}  # token_hash -> last request time
+_last_seen_lock = threading.Lock()
+
+def hash_token(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+def create_session(username):
+    token = str(uuid.uuid4())
+    now = time.time()
+    conn = get_db_connection()
+    conn.execute('''
+        INSERT INTO sessions (token_hash, username, created_at, last_seen, expires_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (hash_token(token), username, now, now, now + SESSION_TTL))
+    conn.commit()
+    return token
+
+def lookup_session(token):
+    """Username for a live session token, or None."""
+    token_hash = hash_token(token)
+    row = get_db_connection().execute(_LOOKUP, (token_hash,)).fetchone()
+    if not row or row[1] < time.time():
+        return None
+    touch_session(token_hash)
+    return row[0]
+
+def touch_session(token_hash):
+    with _last_seen_lock:
+        _last_seen[token_hash] = time.time()
+
+def end_session(token):
+    token_hash = hash_token(token)
+    with _last_seen_lock:
+        _last_seen.pop(token_hash, None)
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('DELETE FROM sessions WHERE token_hash=?', (token_hash,))
+    conn.commit()
+    return c.rowcount > 0
+
+def flush_last_seen():
+    """Write buffered last_seen times in one transaction."""
+    with _last_seen_lock:
+        if not _last_seen:
+            return 0
+        pending = list(_last_seen.items())
+        _last_seen.clear()
+
+    conn = connect()
+    try:
+        conn.executemany(
+            'UPDATE sessions SET last_seen=?, expires_at=? WHERE token_hash=?',
+            [(seen, seen + SESSION_TTL, token_hash) for token_hash, seen in pending]
+        )
+        conn.commit()
+    finally:
+        conn.really_close()
+    return len(pending)
+
+def sweep_expired_sessions():
+    conn = connect()
+    try:
+        c = conn.cursor()
+        c.execute(_SWEEP, (time.time(),))
+        conn.commit()
+        removed = c.rowcount
+    finally:
+        conn.really_close()
+    if removed:
+        print(f"Removed {removed} expired session(s)")
+    return removed
@@ -0,0 +1,64 @@
+import threading
+from flask import request
+from flask_socketio import SocketIO, join_room as join_socket_room
+from app.auth import resolve_token
+from app.store import room_store
+from app.membership import membership
+
+# Push channel for room chat. A client connects with its login token
+# (socket.io auth payload {"token": ...}, ?token= or the Authorization
+# header), gets subscribed to every room it is a member of, and receives
+# a 'room_message' event for each message appended to those rooms.
+
+socketio = SocketIO(cors_allowed_origins='*')
+
+_user_sids = {}  # username -> set of connected socket ids
+_sid_users = {}  # socket id -> username
+_sids_lock = threading.Lock()
+
+def room_channel(room_id):
+    return f'room:{room_id}'
+
+@socketio.on('connect')
+def on_connect(auth=None):
+    token = (auth or {}).get('token') or request.args.get('token') or request.headers.get('Authorization')
+    username = resolve_token(token)
+    if not username:
+        return False
+
+    for room_id in membership.rooms_of(username):
+        join_socket_room(room_channel(room_id))
+        room_store.watch(room_id)
+
+    with _sids_lock:
+        _user_sids.setdefault(username, set()).add(request.sid)
+        _sid_users[request.sid] = username
+
+@socketio.on('disconnect')
+def on_disconnect(*args):
+    with _sids_lock:
+        username = _sid_users.pop(request.sid, None)
+        sids = _user_sids.get(username)
+        if sids is not None:
+            sids.discard(request.sid)
+            if not sids:
+                del _user_sids[username]
+
+def subscribe_user(username, room_id):
+    """Add a user's open sockets to a room they just joined or created."""
+    with _sids_lock:
+        sids = list(_user_sids.get(username, ()))
+    for sid in sids:
+        socketio.server.enter_room(sid, room_channel(room_id), namespace='/')
+    if sids:
+        room_store.watch(room_id)
+
+def _broadcast(msg):
+    # one emit per room: the packet is encoded once and reused for
+    # every subscriber of the room. Runs for messages sent on this worker
+    # and for those the broker delivers from the others.
+    socketio.emit('room_message', msg.to_dict(), to=room_channel(msg.room_id))
+
+def init_app(app):
+    socketio.init_app(app)
+    room_store.add_listener(_broadcast)
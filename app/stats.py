@@ -0,0 +1,75 @@
+import time
+from app.db import connect
+from app.timeline import push_unpulled_authors
+
+# Recomputes user_profile counters from the source tables with a few
+# set-based statements. Triggers (migration 3) record every user whose
+# posts, votes or follow edges changed in stats_dirty, so an incremental
+# run only touches those users.
+
+def _scope(column, incremental):
+    if not incremental:
+        return ''
+    return f'WHERE {column} IN (SELECT username FROM stats_dirty)'
+
+def reconcile_user_stats(incremental=True, db_file=None):
+    """Bring user_profile in line with posts/following, returns rows updated."""
+    conn = connect(db_file)
+    conn.isolation_level = None
+    c = conn.cursor()
+    try:
+        # write lock up front so nothing marks users dirty between the
+        # recount and clearing stats_dirty
+        c.execute('BEGIN IMMEDIATE')
+
+        c.execute(f'''
+            INSERT INTO user_profile (username, followers, following, posts, upvotes, downvotes)
+            SELECT u.username, 0, 0, 0, 0, 0 FROM users u
+            {_scope('u.username', incremental)}
+            {'AND' if incremental else 'WHERE'} NOT EXISTS (SELECT 1 FROM user_profile p WHERE p.username = u.username)
+        ''')
+
+        c.execute(f'''
+            UPDATE user_profile
+            SET posts = s.posts, followers = s.followers, following = s.following,
+                upvotes = s.upvotes, downvotes = s.downvotes
+            FROM (
+                SELECT u.username,
+                       COALESCE(p.posts, 0) AS posts,
+                       COALESCE(p.upvotes, 0) AS upvotes,
+                       COALESCE(p.downvotes, 0) AS downvotes,
+                       COALESCE(fr.n, 0) AS followers,
+                       COALESCE(fg.n, 0) AS following
+                FROM users u
+                LEFT JOIN (SELECT username, COUNT(*) AS posts, SUM(upvotes) AS upvotes, SUM(downvotes) AS downvotes
+                           FROM posts {_scope('username', incremental)} GROUP BY username) p
+                       ON p.username = u.username
+                LEFT JOIN (SELECT following AS username, COUNT(*) AS n
+                           FROM following {_scope('following', incremental)} GROUP BY following) fr
+                       ON fr.username = u.username
+                LEFT JOIN (SELECT follower AS username, COUNT(*) AS n
+                           FROM following {_scope('follower', incremental)} GROUP BY follower) fg
+                       ON fg.username = u.username
+                {_scope('u.username', incremental)}
+            ) AS s
+            WHERE user_profile.username = s.username
+        ''')
+        updated = c.rowcount
+
+        c.execute('DELETE FROM stats_dirty')
+        c.execute('COMMIT')
+    except Exception:
+        if conn.in_transaction:
+            c.execute('ROLLBACK')
+        raise
+    finally:
+        conn.really_close()
+    return updated
+
+def reconcile_job():
+    started = time.time()
+    updated = reconcile_user_stats(incremental=True)
+    if updated:
+        print(f"Reconciled stats for {updated} user(s) in {time.time() - started:.2f}s")
+        # recounted followers may have dropped pulled authors below the threshold
+        push_unpulled_authors()
@@ -1,24 +1,544 @@
-
+import heapq
 import json
-import os
-from app.config import MESSAGES_FILE
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from app.db import connect, hot_query
+from app.archive import RoomArchive
+from app.config import (MAX_MESSAGES, MESSAGE_RETENTION, MESSAGE_COMMIT_TIMEOUT,
+                        ROOM_CACHE_SIZE, ROOM_CACHE_MAX_BYTES, ROOM_CACHE_TTL, ROOM_CACHE_TTL_BROKER,
+                        ROOM_MAX_MESSAGES, ROOM_MAX_BYTES, ROOM_QUOTA_SLACK, ROOM_PAYLOAD_CACHE_SIZE)
+
+class RoomMessage:
+    __slots__ = ('id', 'username', 'message', 'created_at', 'room_id')
+
+    def __init__(self, id, username, message, created_at, room_id):
+        self.id = id
+        self.username = username
+        self.message = message
+        self.created_at = created_at
+        self.room_id = room_id
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'username': self.username,
+            'message': self.message,
+            'created_at': self.created_at,
+            'room_id': self.room_id
+        }
+
+def text_bytes(msg):
+    # what counts against a room's byte quota
+    return len(msg.message.encode('utf-8'))
+
+def encode_messages(messages):
+    """Response body for a page of messages, same shape as jsonify({'messages': ...})."""
+    return json.dumps({'messages': messages}, separators=(',', ':'), sort_keys=True).encode('utf-8')
+
+def room_quota(conn, room_id):
+    """(max messages, max bytes) for a room, the ROOM_MAX_* defaults unless the room overrides them."""
+    row = conn.execute('SELECT max_messages, max_bytes FROM rooms WHERE id=?', (room_id,)).fetchone()
+    max_messages, max_bytes = row if row else (None, None)
+    return max_messages or ROOM_MAX_MESSAGES, max_bytes or ROOM_MAX_BYTES
+
+class RoomTail:
+    """The newest messages of one room as this process last saw them.
+
+    Every unexpired message with an id above `floor` is in `messages`, so
+    reads past that cursor never have to go to the database. The tail
+    keeps to the room's quota and the cache limits, whichever is smaller.
+
+    `payloads` holds encoded response bodies keyed by (after_id, before_id,
+    limit); any change to the messages empties it.
+    """
+    __slots__ = ('messages', 'floor', 'last_id', 'fetched_at', 'bytes', 'max_messages', 'max_bytes',
+                 'payloads')
+
+    def __init__(self, max_messages, max_bytes):
+        self.messages = deque()
+        self.floor = 0
+        self.last_id = 0
+        self.fetched_at = 0.0
+        self.bytes = 0
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.payloads = {}
+
+_COLUMNS = 'id, username, message, created_at, room_id'
+
+# keyset reads on (room_id, id)
+_NEWEST = hot_query(f'''SELECT {_COLUMNS} FROM room_messages
+                        WHERE room_id=? AND created_at > ? ORDER BY id DESC LIMIT ?''', (1, 0, 100))
+_NEWER = hot_query(f'''SELECT {_COLUMNS} FROM room_messages
+                       WHERE room_id=? AND id > ? ORDER BY id LIMIT ?''', (1, 0, 100))
+_AFTER = hot_query(f'''SELECT {_COLUMNS} FROM room_messages
+                       WHERE room_id=? AND id > ? AND created_at > ? ORDER BY id LIMIT ?''', (1, 0, 0, 100))
+_BEFORE = hot_query(f'''SELECT {_COLUMNS} FROM room_messages
+                        WHERE room_id=? AND id < ? ORDER BY id DESC LIMIT ?''', (1, 0, 100))
+# quota trims and expiry, oldest first with their size in bytes
+_OLDEST = hot_query(f'''SELECT {_COLUMNS}, length(CAST(message AS BLOB)) FROM room_messages
+                        WHERE room_id=? ORDER BY id''', (1,))
+_UP_TO = hot_query(f'''SELECT {_COLUMNS}, length(CAST(message AS BLOB)) FROM room_messages
+                       WHERE room_id=? AND id <= ? ORDER BY id''', (1, 0))
+_DELETE_UP_TO = hot_query('DELETE FROM room_messages WHERE room_id=? AND id <= ?', (1, 0))
+_EXPIRED = hot_query('SELECT room_id, id FROM room_messages WHERE created_at <= ?', (0,))
+
+class _PendingWrite:
+    """A send waiting for the writer: 'queued', then 'writing', or 'cancelled'
+    by a sender that gave up before the writer got to it."""
+    __slots__ = ('msg', 'done', 'state')
+
+    def __init__(self, msg):
+        self.msg = msg
+        self.done = threading.Event()
+        self.state = 'queued'
+
+class RoomStore:
+    """Chat messages of all rooms, kept in the room_messages table.
+
+    The table is shared by every worker process. Each room numbers its
+    messages 1, 2, 3... (room_message_seq), the number never goes back so
+    clients can use the last id they saw as a cursor.
+
+    Sends are queued to a single writer thread which inserts everything
+    that piled up in one transaction (group commit). Reads are served from
+    a small per-process cache of each room's newest messages, refreshed
+    from the table at most every `cache_ttl` seconds, so polling stays
+    cheap while messages written by other workers still show up.
+
+    With a broker (app/broker.py) each send is also published to the
+    room's topic, so caches and waiters on the other workers get it right
+    away and the table is only re-checked every `broker_ttl` seconds in
+    case an event got dropped.
+    """
+
+    def __init__(self, max_per_room=MAX_MESSAGES, retention=MESSAGE_RETENTION,
+                 cache_size=ROOM_CACHE_SIZE, cache_max_bytes=ROOM_CACHE_MAX_BYTES,
+                 cache_ttl=ROOM_CACHE_TTL, broker_ttl=ROOM_CACHE_TTL_BROKER, db_file=None, archive=None):
+        self.max_per_room = max_per_room
+        self.retention = retention
+        self.cache_size = max(cache_size, max_per_room)
+        self.cache_max_bytes = cache_max_bytes
+        self.cache_ttl = cache_ttl
+        self.broker_ttl = broker_ttl
+        self.broker = None
+        self._watched = set()  # rooms subscribed on the broker
+        self.db_file = db_file
+        self.archive = archive or RoomArchive()
+        self._tails = {}  # room_id -> RoomTail
+        # (created_at of the oldest cached message, room_id), so expiry
+        # only visits rooms that have something expiring
+        self._expiry_heap = []
+        self._new_message = {}  # room_id -> Condition, notified on local sends
+        self._listeners = []  # called with every appended RoomMessage
+        self._lock = threading.RLock()
+        self._reader = None
+        self._queue = queue.Queue()
+        self._claim_lock = threading.Lock()  # orders the writer taking a send against it being cancelled
+        self._writer = None
+        self._start_lock = threading.Lock()
+
+    # -- writes --
+
+    def _ensure_writer(self):
+        if self._writer is not None:
+            return
+        with self._start_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run, name='room-message-writer', daemon=True)
+                self._writer.start()
+
+    def _run(self):
+        conn = connect(self.db_file)
+        conn.isolation_level = None
+        while True:
+            pending = [self._queue.get()]
+            while True:
+                try:
+                    pending.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            with self._claim_lock:
+                batch = [p for p in pending if p.state == 'queued']
+                for p in batch:
+                    p.state = 'writing'
+            if not batch:
+                continue
+            try:
+                self._write(conn, [p.msg for p in batch])
+            except Exception as e:
+                print(f'Room message write failed: {e}')
+                for p in batch:
+                    p.msg.id = None
+            for p in batch:
+                p.done.set()
+
+    def _write(self, conn, msgs):
+        per_room = {}
+        for msg in msgs:
+            per_room.setdefault(msg.room_id, []).append(msg)
+
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            # one id range per room for the whole batch
+            totals = {}
+            for room_id, room_msgs in per_room.items():
+                c.execute('INSERT OR IGNORE INTO room_message_seq (room_id, last_id) VALUES (?, 0)', (room_id,))
+                c.execute('''UPDATE room_message_seq SET last_id = last_id + ?, message_count = message_count + ?,
+                             byte_count = byte_count + ? WHERE room_id=?''',
+                          (len(room_msgs), len(room_msgs), sum(text_bytes(m) for m in room_msgs), room_id))
+                last_id, count, nbytes = c.execute('''SELECT last_id, message_count, byte_count
+                                                      FROM room_message_seq WHERE room_id=?''', (room_id,)).fetchone()
+                for offset, msg in enumerate(room_msgs):
+                    msg.id = last_id - len(room_msgs) + 1 + offset
+                totals[room_id] = (count, nbytes)
+            c.executemany(f'INSERT INTO room_messages ({_COLUMNS}) VALUES (?, ?, ?, ?, ?)',
+                          [(m.id, m.username, m.message, m.created_at, m.room_id) for m in msgs])
+            for room_id, (count, nbytes) in totals.items():
+                self._enforce_quota(conn, c, room_id, count, nbytes)
+            c.execute('COMMIT')
+        except Exception:
+            c.execute('ROLLBACK')
+            raise
+
+    def _enforce_quota(self, conn, c, room_id, count, nbytes):
+        # drop a busy room's oldest messages, other rooms are not affected
+        max_messages, max_bytes = room_quota(conn, room_id)
+        if count <= max_messages and nbytes <= max_bytes:
+            return
+        # once over, go a bit under so trims (and archive blocks) come in batches
+        max_messages = max(int(max_messages * (1 - ROOM_QUOTA_SLACK)), 1)
+        max_bytes = int(max_bytes * (1 - ROOM_QUOTA_SLACK))
+        freed = 0
+        dropped = []
+        oldest = conn.execute(_OLDEST, (room_id,))
+        for row in oldest:
+            remaining = count - len(dropped)
+            if remaining <= 1 or (remaining <= max_messages and nbytes - freed <= max_bytes):
+                break
+            dropped.append(RoomMessage(*row[:5]).to_dict())
+            freed += row[5]
+        oldest.close()
+        if not dropped:
+            return
+        # still readable as history, see app/archive.py
+        self.archive.append(room_id, dropped)
+        c.execute(_DELETE_UP_TO, (room_id, dropped[-1]['id']))
+        c.execute('''UPDATE room_message_seq SET message_count = message_count - ?, byte_count = byte_count - ?
+                     WHERE room_id=?''', (len(dropped), freed, room_id))
+
+    def append(self, room_id, username, message, created_at=None):
+        """Store a message; returns once it is committed to the database."""
+        msg = RoomMessage(None, username, message, created_at or time.time(), int(room_id))
+        pending = _PendingWrite(msg)
+        self._ensure_writer()
+        self._queue.put(pending)
+        if not pending.done.wait(MESSAGE_COMMIT_TIMEOUT):
+            with self._claim_lock:
+                if pending.state == 'queued':
+                    # never written, so a retry cannot duplicate it
+                    pending.state = 'cancelled'
+                    raise RuntimeError('could not store room message')
+            # already in a transaction, its outcome is what the client gets
+            pending.done.wait()
+        if msg.id is None:
+            raise RuntimeError('could not store room message')
+
+        with self._lock:
+            self._remember(msg)
+        if self.broker is not None:
+            self.broker.publish(f'room:{msg.room_id}', msg.to_dict())
+        self._notify_listeners(msg)
+        return msg
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def _notify_listeners(self, msg):
+        for listener in self._listeners:
+            try:
+                listener(msg)
+            except Exception as e:
+                print(f'Room message listener failed: {e}')
+
+    # -- other workers' messages --
+
+    def use_broker(self, broker):
+        if self.broker is broker:
+            return
+        self.broker = broker
+        broker.on_connect(self._broker_connected)
+
+    def watch(self, room_id):
+        """Subscribe to a room's messages from other workers (no-op without a broker)."""
+        room_id = int(room_id)
+        if self.broker is None or room_id in self._watched:
+            return
+        self._watched.add(room_id)
+        self.broker.subscribe(f'room:{room_id}', self._deliver)
+
+    def _deliver(self, data):
+        msg = RoomMessage(data['id'], data['username'], data['message'], data['created_at'], data['room_id'])
+        with self._lock:
+            self._remember(msg)
+        self._notify_listeners(msg)
+
+    def _broker_connected(self):
+        # anything sent while we were not connected was missed
+        with self._lock:
+            for tail in self._tails.values():
+                tail.fetched_at = 0.0
+            for cond in self._new_message.values():
+                cond.notify_all()
+
+    def _ttl(self):
+        if self.broker is not None and self.broker.connected:
+            return self.broker_ttl
+        return self.cache_ttl
+
+    # -- per-process tail cache --
+
+    def _query(self, sql, params):
+        if self._reader is None:
+            self._reader = connect(self.db_file)
+        rows = self._reader.execute(sql, params).fetchall()
+        return [RoomMessage(*row) for row in rows]
+
+    def _cutoff(self, now):
+        return now - self.retention
+
+    def _push(self, tail, msg):
+        if not tail.messages:
+            heapq.heappush(self._expiry_heap, (msg.created_at, msg.room_id))
+        tail.messages.append(msg)
+        tail.bytes += text_bytes(msg)
+        tail.last_id = msg.id
+        tail.payloads.clear()
+        while len(tail.messages) > 1 and (len(tail.messages) > tail.max_messages or tail.bytes > tail.max_bytes):
+            dropped = tail.messages.popleft()
+            tail.bytes -= text_bytes(dropped)
+            tail.floor = dropped.id
+
+    def _expire_tail(self, tail, cutoff):
+        while tail.messages and tail.messages[0].created_at <= cutoff:
+            tail.bytes -= text_bytes(tail.messages.popleft())
+            tail.payloads.clear()
+
+    def _remember(self, msg):
+        tail = self._tails.get(msg.room_id)
+        if tail is not None:
+            if msg.id == tail.last_id + 1:
+                self._push(tail, msg)
+            elif msg.id > tail.last_id:
+                # another worker sent in between, pick it up on the next read
+                tail.fetched_at = 0.0
+        waiters = self._new_message.get(msg.room_id)
+        if waiters is not None:
+            waiters.notify_all()
+
+    def _load_tail(self, room_id, now):
+        if self._reader is None:
+            self._reader = connect(self.db_file)
+        max_messages, max_bytes = room_quota(self._reader, room_id)
+        tail = RoomTail(min(max_messages, self.cache_size), min(max_bytes, self.cache_max_bytes))
+        newest = self._query(_NEWEST, (room_id, self._cutoff(now), tail.max_messages))
+        newest.reverse()
+        if len(newest) == tail.max_messages:
+            tail.floor = newest[0].id - 1
+        for msg in newest:
+            self._push(tail, msg)
+        return tail
+
+    def _refresh(self, room_id):
+        now = time.time()
+        tail = self._tails.get(room_id)
+        if tail is not None and now - tail.fetched_at < self._ttl():
+            return tail
+        if tail is None:
+            self.watch(room_id)
+            tail = self._load_tail(room_id, now)
+        else:
+            newer = self._query(_NEWER, (room_id, tail.last_id, tail.max_messages + 1))
+            if len(newer) > tail.max_messages:
+                tail = self._load_tail(room_id, now)
+            else:
+                for msg in newer:
+                    self._push(tail, msg)
+        self._expire_tail(tail, self._cutoff(now))
+        tail.fetched_at = now
+        self._tails[room_id] = tail
+        return tail
+
+    # -- reads --
 
-# Load messages from file if exists, else create file
-def load_messages():
-    if os.path.exists(MESSAGES_FILE):
-        with open(MESSAGES_FILE, "r", encoding="utf-8") as f:
+    def get(self, room_id, after_id=0, before_id=None, limit=None):
+        """A page of messages of a room, oldest first.
+
+        With after_id: up to `limit` messages right after that id.
+        Otherwise: the newest `limit` messages, older than before_id if given.
+        """
+        room_id = int(room_id)
+        limit = max(min(limit or self.max_per_room, self.max_per_room), 1)
+        with self._lock:
+            tail = self._refresh(room_id)
+            if after_id and after_id >= tail.floor:
+                page = []
+                for m in tail.messages:
+                    if m.id > after_id:
+                        page.append(m.to_dict())
+                        if len(page) == limit:
+                            break
+                return page
+            if not after_id and before_id is None and (tail.floor == 0 or len(tail.messages) >= limit):
+                return [m.to_dict() for m in list(tail.messages)[-limit:]]
+
+            # older than the cache goes to the table, keyset on (room_id, id)
+            cutoff = self._cutoff(time.time())
+            if after_id:
+                page = self._query(_AFTER, (room_id, after_id, cutoff, limit))
+                return [m.to_dict() for m in page]
+            if before_id is None:
+                page = self._query(_NEWEST, (room_id, cutoff, limit))
+                return [m.to_dict() for m in reversed(page)]
+
+            # scrolling back: whatever the table still has, then the archive
+            page = self._query(_BEFORE, (room_id, before_id, limit))
+        page = [m.to_dict() for m in reversed(page)]
+        if len(page) < limit:
+            page = self.archive.read_before(room_id, page[0]['id'] if page else before_id, limit - len(page)) + page
+        return page
+
+    def wait(self, room_id, after_id, timeout):
+        """Block until the room has a message newer than after_id or timeout runs out.
+
+        Local sends and sends delivered by the broker wake the waiters
+        right away; without a broker sends from other workers are noticed
+        on the next cache refresh. Returns the new messages, or [] on timeout.
+        """
+        room_id = int(room_id)
+        deadline = time.time() + timeout
+        with self._lock:
+            cond = self._new_message.get(room_id)
+            if cond is None:
+                cond = self._new_message[room_id] = threading.Condition(self._lock)
+            while True:
+                if self._refresh(room_id).last_id > after_id:
+                    return self.get(room_id, after_id)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return []
+                cond.wait(min(remaining, self._ttl()))
+
+    def get_encoded(self, room_id, after_id=0, before_id=None, limit=None):
+        """Same page as get(), as a JSON response body, plus the room's etag.
+
+        Bodies are kept per cursor until the room changes, so of all the
+        members polling a room only the first read after a send pays for
+        building and encoding the page.
+        """
+        room_id = int(room_id)
+        limit = max(min(limit or self.max_per_room, self.max_per_room), 1)
+        key = (after_id, before_id, limit)
+        with self._lock:
+            tail = self._refresh(room_id)
+            body = tail.payloads.get(key)
+            if body is None:
+                body = encode_messages(self.get(room_id, after_id, before_id, limit))
+                if len(tail.payloads) >= ROOM_PAYLOAD_CACHE_SIZE:
+                    tail.payloads.clear()
+                tail.payloads[key] = body
+            return body, self._etag(room_id, tail)
+
+    def _etag(self, room_id, tail):
+        first_id = tail.messages[0].id if tail.messages else 0
+        return f'{room_id}-{first_id}-{tail.last_id}'
+
+    def etag(self, room_id):
+        """Changes whenever a message is added to or expires from the room."""
+        room_id = int(room_id)
+        with self._lock:
+            return self._etag(room_id, self._refresh(room_id))
+
+    def expire(self):
+        """Move messages past the retention period to the archive, returns how many went.
+
+        The table side is a range on the created_at index and the cache side
+        pops the expiry heap, so only messages that actually expired are
+        touched.
+        """
+        now = time.time()
+        cutoff = self._cutoff(now)
+        conn = connect(self.db_file)
+        conn.isolation_level = None
+        c = conn.cursor()
+        try:
+            c.execute('BEGIN IMMEDIATE')
             try:
-                return json.load(f)
+                # newest expired id per room, grouped here so the read stays
+                # a range on the created_at index
+                newest = {}
+                for room_id, msg_id in c.execute(_EXPIRED, (cutoff,)):
+                    newest[room_id] = max(newest.get(room_id, 0), msg_id)
+                # everything up to it goes, so history is archived in id
+                # order even where created_at and id disagree
+                per_room = {}
+                for room_id, max_id in newest.items():
+                    rows = c.execute(_UP_TO, (room_id, max_id)).fetchall()
+                    # still readable as history, see app/archive.py
+                    self.archive.append(room_id, [RoomMessage(*row[:5]).to_dict() for row in rows])
+                    c.execute(_DELETE_UP_TO, (room_id, max_id))
+                    per_room[room_id] = (len(rows), sum(row[5] for row in rows))
+                c.executemany('''UPDATE room_message_seq SET message_count = message_count - ?,
+                                 byte_count = byte_count - ? WHERE room_id=?''',
+                              [(count, nbytes, room_id) for room_id, (count, nbytes) in per_room.items()])
+                c.execute('COMMIT')
             except Exception:
-                return []
-    else:
-        with open(MESSAGES_FILE, "w", encoding="utf-8") as f:
-            json.dump([], f)
-        return []
-
-def save_messages(messages):
-    with open(MESSAGES_FILE, "w", encoding="utf-8") as f:
-        json.dump(messages, f)
-
-# Global messages list
-messages = load_messages()
+                c.execute('ROLLBACK')
+                raise
+        finally:
+            conn.really_close()
+
+        with self._lock:
+            while self._expiry_heap and self._expiry_heap[0][0] <= cutoff:
+                _, room_id = heapq.heappop(self._expiry_heap)
+                tail = self._tails.get(room_id)
+                if tail is None:
+                    continue
+                self._expire_tail(tail, cutoff)
+                if tail.messages:
+                    heapq.heappush(self._expiry_heap, (tail.messages[0].created_at, room_id))
+                elif room_id not in self._new_message:
+                    del self._tails[room_id]
+        return sum(count for count, _ in per_room.values())
+
+    def usage(self):
+        """Per-room message counts and sizes, in this process's cache and in the table.
+
+        Rooms only this process's cache knows about count as private.
+        """
+        if self._reader is None:
+            self._reader = connect(self.db_file)
+        with self._lock:
+            rooms = {}
+            for room_id, tail in self._tails.items():
+                memory = sum(sys.getsizeof(m) + sys.getsizeof(m.message) + sys.getsizeof(m.username)
+                             for m in tail.messages)
+                rooms[room_id] = {'room_id': room_id, 'is_private': True, 'cached_messages': len(tail.messages),
+                                  'cached_bytes': tail.bytes, 'cache_memory_bytes': memory}
+            stored = self._reader.execute('''SELECT s.room_id, s.message_count, s.byte_count, r.max_messages, r.max_bytes,
+                                                    r.is_private
+                                            FROM room_message_seq s LEFT JOIN rooms r ON r.id = s.room_id''').fetchall()
+        for room_id, count, nbytes, max_messages, max_bytes, is_private in stored:
+            room = rooms.setdefault(room_id, {'room_id': room_id, 'cached_messages': 0,
+                                              'cached_bytes': 0, 'cache_memory_bytes': 0})
+            room.update({'is_private': bool(is_private) if is_private is not None else True,
+                         'stored_messages': count, 'stored_bytes': nbytes,
+                         'max_messages': max_messages or ROOM_MAX_MESSAGES, 'max_bytes': max_bytes or ROOM_MAX_BYTES})
+        return sorted(rooms.values(), key=lambda room: room['cache_memory_bytes'], reverse=True)
+
+# Global room message store
+room_store = RoomStore()
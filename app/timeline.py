@@ -0,0 +1,202 @@
+import heapq
+import queue
+import threading
+from app.db import connect, hot_query
+from app.config import TIMELINE_LENGTH, FANOUT_FOLLOWER_THRESHOLD
+
+# Materialized home timelines: home_timeline(owner, score, post_id) holds,
+# for every user, the newest posts of the accounts they follow (score is
+# the post's unix time). The feed reads one owner's range of the primary
+# key instead of assembling it from posts/following on every request.
+#
+# Writes come from the request handlers as jobs for a background thread,
+# which applies everything that queued up in one transaction:
+#   post     copy a new post into the timeline of each follower
+#   follow   backfill the newest posts of the followed account
+#   unfollow take the unfollowed account's posts out again
+# Timelines are trimmed back to TIMELINE_LENGTH by trim_timelines(), run
+# from the scheduler, so fan-out never pays for it.
+#
+# Authors with FANOUT_FOLLOWER_THRESHOLD or more followers (per
+# user_profile.followers) are not pushed: one of their posts would mean
+# that many timeline rows. read_home_timeline() pulls their newest posts
+# instead and merges them with the pushed rows, so neither posting nor
+# reading gets slower with the size of the audience. Skipped authors are
+# recorded in pulled_authors; once one is back below the threshold
+# (unfollows, or a recount by the stats job) the posts made while they
+# were pulled are copied in once:
+#   unpulled push the newest posts of such authors to all of their followers
+
+_SCORE = "CAST(strftime('%s', p.created_at) AS INTEGER)"
+
+# true for authors that are pulled at read time
+_PULLED = 'EXISTS (SELECT 1 FROM user_profile up WHERE up.username = {author} AND up.followers >= ?)'
+
+_POST_COLUMNS = 'p.id, p.username, p.content, p.created_at, p.upvotes, p.downvotes'
+
+_FAN_OUT_POST = hot_query(f'''INSERT OR IGNORE INTO home_timeline (owner, score, post_id)
+                              SELECT f.follower, {_SCORE}, p.id FROM posts p
+                              JOIN following f ON f.following = p.username
+                              WHERE p.id=? AND NOT {_PULLED.format(author='p.username')}''', (1, 1000))
+_BACKFILL = hot_query(f'''INSERT OR IGNORE INTO home_timeline (owner, score, post_id)
+                          SELECT ?, {_SCORE}, p.id FROM posts p
+                          WHERE p.username=? AND NOT {_PULLED.format(author='p.username')}
+                          ORDER BY p.created_at DESC LIMIT ?''', ('u', 'v', 1000, 500))
+_PUSH_AUTHOR = hot_query(f'''INSERT OR IGNORE INTO home_timeline (owner, score, post_id)
+                             SELECT f.follower, p.score, p.id FROM following f
+                             JOIN (SELECT {_SCORE} AS score, p.id FROM posts p
+                                   WHERE p.username=? ORDER BY p.created_at DESC LIMIT ?) p
+                             WHERE f.following=?''', ('u', 500, 'u'))
+# remember who fan-out skipped
+_MARK_POST_AUTHOR = hot_query('''INSERT OR IGNORE INTO pulled_authors (username)
+                                 SELECT up.username FROM posts p JOIN user_profile up ON up.username = p.username
+                                 WHERE p.id=? AND up.followers >= ?''', (1, 1000))
+_MARK_AUTHOR = hot_query('''INSERT OR IGNORE INTO pulled_authors (username)
+                            SELECT username FROM user_profile WHERE username=? AND followers >= ?''', ('u', 1000))
+_UNPULLED_AUTHOR = hot_query('''SELECT pa.username FROM pulled_authors pa
+                                JOIN user_profile up ON up.username = pa.username
+                                WHERE pa.username=? AND up.followers < ?''', ('u', 1000))
+# all of them, only from the stats job (pulled_authors stays small)
+_UNPULLED = '''SELECT pa.username FROM pulled_authors pa
+               JOIN user_profile up ON up.username = pa.username WHERE up.followers < ?'''
+_UNFOLLOW = hot_query('''DELETE FROM home_timeline WHERE owner=?
+                         AND post_id IN (SELECT id FROM posts WHERE username=?)''', ('u', 'v'))
+
+_TIMELINE_FIRST = hot_query(f'''SELECT t.score, {_POST_COLUMNS} FROM home_timeline t JOIN posts p ON p.id = t.post_id
+                                WHERE t.owner=? ORDER BY t.score DESC, t.post_id DESC LIMIT ?''', ('u', 20))
+_TIMELINE_NEXT = hot_query(f'''SELECT t.score, {_POST_COLUMNS} FROM home_timeline t JOIN posts p ON p.id = t.post_id
+                               WHERE t.owner=? AND (t.score, t.post_id) < (?, ?)
+                               ORDER BY t.score DESC, t.post_id DESC LIMIT ?''', ('u', 0, 0, 20))
+_PULLED_FOLLOWED = hot_query('''SELECT f.following FROM following f JOIN user_profile up ON up.username = f.following
+                                WHERE f.follower=? AND up.followers >= ?''', ('u', 1000))
+_PULLED_FIRST = hot_query(f'''SELECT {_SCORE}, {_POST_COLUMNS} FROM posts p
+                              WHERE p.username=? ORDER BY p.created_at DESC, p.id DESC LIMIT ?''', ('u', 20))
+# created_at has whole seconds, so this orders exactly like the score
+_PULLED_NEXT = hot_query(f'''SELECT {_SCORE}, {_POST_COLUMNS} FROM posts p
+                             WHERE p.username=? AND (p.created_at, p.id) < (datetime(?, 'unixepoch'), ?)
+                             ORDER BY p.created_at DESC, p.id DESC LIMIT ?''', ('u', 0, 0, 20))
+
+_jobs = queue.Queue()
+_worker = None
+_worker_lock = threading.Lock()
+
+def _ensure_worker():
+    global _worker
+    if _worker is not None:
+        return
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(target=_run, name='timeline-fanout', daemon=True)
+            _worker.start()
+
+def fan_out_post(post_id):
+    _ensure_worker()
+    _jobs.put(('post', post_id))
+
+def backfill_follow(follower, following):
+    _ensure_worker()
+    _jobs.put(('follow', follower, following))
+
+def remove_follow(follower, following):
+    _ensure_worker()
+    _jobs.put(('unfollow', follower, following))
+
+def push_unpulled_authors(username=None):
+    """Push the posts of pulled authors that are back below the threshold.
+
+    Checks one author, or all of them when username is None.
+    """
+    _ensure_worker()
+    _jobs.put(('unpulled', username))
+
+def _apply(c, job):
+    kind = job[0]
+    if kind == 'post':
+        c.execute(_FAN_OUT_POST, (job[1], FANOUT_FOLLOWER_THRESHOLD))
+        c.execute(_MARK_POST_AUTHOR, (job[1], FANOUT_FOLLOWER_THRESHOLD))
+    elif kind == 'follow':
+        c.execute(_BACKFILL, (job[1], job[2], FANOUT_FOLLOWER_THRESHOLD, TIMELINE_LENGTH))
+        c.execute(_MARK_AUTHOR, (job[2], FANOUT_FOLLOWER_THRESHOLD))
+    elif kind == 'unpulled':
+        if job[1] is None:
+            c.execute(_UNPULLED, (FANOUT_FOLLOWER_THRESHOLD,))
+        else:
+            c.execute(_UNPULLED_AUTHOR, (job[1], FANOUT_FOLLOWER_THRESHOLD))
+        for (author,) in c.fetchall():
+            c.execute(_PUSH_AUTHOR, (author, TIMELINE_LENGTH, author))
+            c.execute('DELETE FROM pulled_authors WHERE username=?', (author,))
+    elif kind == 'unfollow':
+        c.execute(_UNFOLLOW, (job[1], job[2]))
+
+def _run():
+    conn = connect()
+    conn.isolation_level = None
+    c = conn.cursor()
+    while True:
+        batch = [_jobs.get()]
+        while True:
+            try:
+                batch.append(_jobs.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            c.execute('BEGIN IMMEDIATE')
+            try:
+                for job in batch:
+                    _apply(c, job)
+                c.execute('COMMIT')
+            except Exception:
+                c.execute('ROLLBACK')
+                raise
+        except Exception as e:
+            print(f'Timeline fan-out failed: {e}')
+
+def trim_timelines(db_file=None):
+    """Cut every timeline back to its newest TIMELINE_LENGTH posts, returns rows deleted."""
+    conn = connect(db_file)
+    try:
+        c = conn.cursor()
+        c.execute('''DELETE FROM home_timeline WHERE (owner, score, post_id) IN (
+                         SELECT owner, score, post_id FROM (
+                             SELECT owner, score, post_id, ROW_NUMBER() OVER (
+                                 PARTITION BY owner ORDER BY score DESC, post_id DESC) AS rank
+                             FROM home_timeline)
+                         WHERE rank > ?)''', (TIMELINE_LENGTH,))
+        deleted = c.rowcount
+        conn.commit()
+        return deleted
+    finally:
+        conn.really_close()
+
+def read_home_timeline(c, username, limit, before=None):
+    """Newest posts of the accounts a user follows, as (score, posts row...).
+
+    The pushed timeline and the newest posts of every followed
+    high-follower author are each already newest first; a k-way merge
+    takes the first `limit` of all of them. `before` is the (score,
+    post id) of the last row of the previous page, None for the first page.
+    """
+    if before is None:
+        c.execute(_TIMELINE_FIRST, (username, limit))
+    else:
+        c.execute(_TIMELINE_NEXT, (username, *before, limit))
+    sources = [c.fetchall()]
+    c.execute(_PULLED_FOLLOWED, (username, FANOUT_FOLLOWER_THRESHOLD))
+    for (author,) in c.fetchall():
+        if before is None:
+            c.execute(_PULLED_FIRST, (author, limit))
+        else:
+            c.execute(_PULLED_NEXT, (author, *before, limit))
+        sources.append(c.fetchall())
+
+    rows = []
+    seen = set()
+    # an author that crossed the threshold can be in both, keep one copy
+    for row in heapq.merge(*sources, key=lambda row: (row[0], row[1]), reverse=True):
+        if row[1] in seen:
+            continue
+        seen.add(row[1])
+        rows.append(row)
+        if len(rows) == limit:
+            break
+    return rows
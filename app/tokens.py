@@ -0,0 +1,79 @@
+import threading
+import time
+import jwt
+from app.db import connect
+from app.config import SECRET_KEY, TOKEN_TTL, REVOCATION_REFRESH
+
+# Signed (HS256) session tokens, used when AUTH_TOKEN_MODE == 'signed'.
+# Verifying one is pure CPU; the only shared state is a per-user logout
+# cutoff: tokens issued at or before a user's last logout are rejected.
+
+ALGORITHM = 'HS256'
+
+_revoked_before = {}  # username -> time of last logout
+_revocations_loaded_at = 0.0
+_lock = threading.Lock()
+
+def looks_signed(token):
+    return token.count('.') == 2
+
+def issue_token(username):
+    now = time.time()
+    payload = {'sub': username, 'iat': now, 'exp': int(now + TOKEN_TTL)}
+    return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+
+def _refresh_revocations():
+    """Reload logout cutoffs so logouts on other workers are honoured."""
+    global _revocations_loaded_at
+    now = time.time()
+    if now - _revocations_loaded_at < REVOCATION_REFRESH:
+        return
+    with _lock:
+        if now - _revocations_loaded_at < REVOCATION_REFRESH:
+            return
+        conn = connect()
+        try:
+            rows = conn.execute('SELECT username, revoked_at FROM token_revocations WHERE revoked_at > ?',
+                                (now - TOKEN_TTL,)).fetchall()
+        finally:
+            conn.really_close()
+        loaded = dict(rows)
+        # keep local logouts that may not have been committed when we read
+        for username, revoked_at in _revoked_before.items():
+            if revoked_at > max(loaded.get(username, 0), now - TOKEN_TTL):
+                loaded[username] = revoked_at
+        _revoked_before.clear()
+        _revoked_before.update(loaded)
+        _revocations_loaded_at = now
+
+def verify_token(token):
+    """Username for a valid signed token, else None."""
+    if not SECRET_KEY:
+        # opaque mode without a configured key, nothing can be signed
+        return None
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM],
+                             options={'require': ['sub', 'iat', 'exp']})
+    except jwt.InvalidTokenError:
+        return None
+    username = payload['sub']
+    _refresh_revocations()
+    cutoff = _revoked_before.get(username)
+    if cutoff is not None and payload['iat'] <= cutoff:
+        return None
+    return username
+
+def revoke_user_tokens(username):
+    """Invalidate every signed token issued to `username` so far."""
+    now = time.time()
+    with _lock:
+        _revoked_before[username] = now
+    conn = connect()
+    try:
+        conn.execute('INSERT OR REPLACE INTO token_revocations (username, revoked_at) VALUES (?, ?)',
+                     (username, now))
+        # cutoffs older than the token lifetime can't match anything any more
+        conn.execute('DELETE FROM token_revocations WHERE revoked_at < ?', (now - TOKEN_TTL,))
+        conn.commit()
+    finally:
+        conn.really_close()
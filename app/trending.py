@@ -0,0 +1,191 @@
+import heapq
+import re
+import threading
+import time
+from collections import Counter, deque
+from operator import itemgetter
+from app.db import connect, hot_query
+from app.config import TRENDING_WINDOW, TRENDING_HALF_LIFE, TRENDING_TOP_K, TRENDING_REFRESH
+
+# Trending hashtags over a sliding window of per-minute buckets.
+#
+# Tags are pulled out of a post once, at create_post, and stored in
+# post_hashtags; each worker also counts them here. A use counts less the
+# older it is (halving every TRENDING_HALF_LIFE minutes) and not at all
+# after TRENDING_WINDOW minutes.
+#
+# The decay is applied "forward": a use in minute m is added with weight
+# 2 ** ((m - landmark) / half_life), which only grows, so a tag's score is
+# a plain running sum that never needs to be recomputed - only the bucket
+# leaving the window is subtracted again. Dividing by the current weight
+# turns a score back into "uses as of now". The landmark moves forward
+# (on reads and writes) before the weights get too large for a float.
+#
+# Uses on other workers arrive over the broker; after a (re)connect, or
+# the first time it is needed, the window is reloaded from post_hashtags.
+
+_HASHTAG = re.compile(r'#(\w+)')
+_MAX_EXPONENT = 512
+
+_WINDOW = hot_query('''SELECT tag, CAST(strftime('%s', created_at) AS INTEGER) FROM post_hashtags
+                       WHERE created_at >= datetime(?, 'unixepoch')''', (0,))
+
+def normalize_hashtag(tag):
+    """Lowercased tag without its '#', None if it is not a valid hashtag."""
+    tag = (tag or '').removeprefix('#')
+    return tag.lower() if _HASHTAG.fullmatch('#' + tag) else None
+
+def extract_hashtags(content):
+    """Distinct, lowercased hashtags of a post in the order they appear."""
+    return list(dict.fromkeys(tag.lower() for tag in _HASHTAG.findall(content or '')))
+
+class TrendingTags:
+
+    def __init__(self, window=TRENDING_WINDOW, half_life=TRENDING_HALF_LIFE,
+                 top_k=TRENDING_TOP_K, refresh=TRENDING_REFRESH):
+        self.window = window
+        self.half_life = half_life
+        self.top_k = top_k
+        self.refresh = refresh
+        self._buckets = deque()  # (minute, Counter of tag -> uses), oldest first
+        self._scores = {}  # tag -> decayed uses in the window, scaled by the landmark
+        self._counts = Counter()  # tag -> uses in the window
+        self._landmark = int(time.time() // 60)
+        self._top = []
+        self._top_at = 0.0
+        self._dirty = False
+        self._loaded = False
+        self._lock = threading.Lock()
+        self.broker = None
+
+    def use_broker(self, broker):
+        if self.broker is broker:
+            return
+        self.broker = broker
+        broker.subscribe('hashtags', lambda data: self._add(data['tags'], data['at']))
+        broker.on_connect(self.clear)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+            self._scores.clear()
+            self._counts.clear()
+            self._top = []
+            self._top_at = 0.0
+            self._loaded = False
+
+    def _weight(self, minute):
+        return 2 ** ((minute - self._landmark) / self.half_life)
+
+    def _rescale(self, minute):
+        # move the landmark up to minute once weights there would get too large
+        if (minute - self._landmark) / self.half_life <= _MAX_EXPONENT:
+            return
+        # 1 / weight(minute), which underflows to 0 instead of overflowing
+        # after a long quiet spell
+        factor = 2 ** ((self._landmark - minute) / self.half_life)
+        for tag in self._scores:
+            self._scores[tag] *= factor
+        self._landmark = minute
+
+    def _load(self):
+        if self._loaded:
+            return
+        since = (int(time.time() // 60) - self.window + 1) * 60
+        conn = connect()
+        try:
+            rows = conn.execute(_WINDOW, (since,)).fetchall()
+        finally:
+            conn.really_close()
+        with self._lock:
+            if self._loaded:
+                return
+            for tag, at in rows:
+                self._count([tag], at)
+            self._loaded = True
+            self._dirty = True
+
+    def _bucket(self, minute):
+        # nearly always the newest one, broker events may be a little late
+        for entry in reversed(self._buckets):
+            if entry[0] == minute:
+                return entry[1]
+            if entry[0] < minute:
+                break
+        counts = Counter()
+        self._buckets.append((minute, counts))
+        if len(self._buckets) > 1 and self._buckets[-2][0] > minute:
+            self._buckets = deque(sorted(self._buckets, key=itemgetter(0)))
+        return counts
+
+    def _count(self, tags, at):
+        minute = int(at // 60)
+        if minute <= int(time.time() // 60) - self.window or not tags:
+            return
+        self._rescale(minute)
+        bucket = self._bucket(minute)
+        weight = self._weight(minute)
+        for tag in tags:
+            bucket[tag] += 1
+            self._counts[tag] += 1
+            self._scores[tag] = self._scores.get(tag, 0.0) + weight
+        self._dirty = True
+
+    def _add(self, tags, at):
+        with self._lock:
+            if self._loaded:
+                self._count(tags, at)
+
+    def add(self, tags, at=None):
+        """Count the hashtags of a new post, call after it is committed."""
+        if not tags:
+            return
+        at = time.time() if at is None else at
+        if self._loaded:
+            self._add(tags, at)
+        else:
+            # the post is committed, so loading the window counts it
+            self._load()
+        if self.broker is not None:
+            self.broker.publish('hashtags', {'tags': tags, 'at': at})
+
+    def _expire(self, now_minute):
+        while self._buckets and self._buckets[0][0] <= now_minute - self.window:
+            minute, counts = self._buckets.popleft()
+            weight = self._weight(minute)
+            for tag, n in counts.items():
+                self._counts[tag] -= n
+                if self._counts[tag] <= 0:
+                    del self._counts[tag]
+                    del self._scores[tag]
+                else:
+                    self._scores[tag] -= n * weight
+            self._dirty = True
+        self._rescale(now_minute)
+
+    def top(self):
+        """The top_k tags as (tag, decayed uses, uses in the window), best first.
+
+        Rebuilt at most every `refresh` seconds, and only if something changed.
+        """
+        now = time.time()
+        if now - self._top_at < self.refresh:
+            return self._top
+        self._load()
+        with self._lock:
+            now_minute = int(now // 60)
+            self._expire(now_minute)
+            if self._dirty:
+                best = heapq.nlargest(self.top_k, self._scores.items(), key=itemgetter(1))
+                scale = self._weight(now_minute)
+                self._top = [(tag, round(score / scale, 3), self._counts[tag]) for tag, score in best]
+                self._dirty = False
+            self._top_at = now
+            return self._top
+
+    def stats(self):
+        with self._lock:
+            return {'tags': len(self._counts), 'buckets': len(self._buckets), 'loaded': self._loaded}
+
+# per-process counter
+trending = TrendingTags()
@@ -3,7 +3,6 @@ import hashlib
 import markdown
 from bleach.sanitizer import Cleaner
 import requests
-import time
 from app.config import UPLOAD_URL, ALLOWED_TAGS, ALLOWED_ATTRIBUTES
 
 def hash_pw(password: str) -> str:
@@ -40,11 +39,10 @@ def file_uploader(file):
     except Exception as err:
         raise Exception(f'Unexpected error during file upload: {str(err)}')
 
-def ping_server(interval=60):
-    while True:
-        try:
-            res = requests.get('https://cpp-webserver.onrender.com', timeout=5)
-            print(f'Ping: {res.status_code} - {res.reason}')
-        except Exception as e:
-            print(f'Ping failed: {e}')
-        time.sleep(interval)
+def ping_upload_service():
+    """Keep the upload service on render.com from going to sleep."""
+    try:
+        res = requests.get('https://cpp-webserver.onrender.com', timeout=5)
+        print(f'Ping: {res.status_code} - {res.reason}')
+    except Exception as e:
+        print(f'Ping failed: {e}')
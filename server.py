@@ -1,7 +1,11 @@
 
 from app import create_app
+from app.sockets import socketio
 
-app = create_app()
+# the password hashing workers are spawned and import this file again as
+# __mp_main__, they must not start a second app
+if __name__ != '__mp_main__':
+    app = create_app()
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    socketio.run(app, host='0.0.0.0', port=5000, debug=True, allow_unsafe_werkzeug=True)
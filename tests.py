@@ -3,6 +3,8 @@ import requests
 import time
 import uuid
 import sys
+import os
+import tempfile
 
 # Default configuration
 BASE_URL = "http://127.0.0.1:5000/api"
@@ -114,5 +116,91 @@ def run_tests():
     except Exception as e:
         print(f"\n❌ Unexpected error: {e}")
 
+def run_query_plan_checks():
+    """Build a scratch database and make sure no hot query scans a table."""
+    from app.db import init_db, connect, check_query_plans
+
+    print("Checking query plans for hot queries...")
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "plans.sqlite")
+        init_db(db_file)
+        conn = connect(db_file)
+        failures = check_query_plans(conn)
+        conn.really_close()
+
+    if failures:
+        for query, detail in failures:
+            print(f"❌ {detail}\n   {query}")
+        return False
+    print("✅ All hot queries use an index")
+    return True
+
+def run_home_timeline_checks():
+    """Posts of a followed high-follower author must show up on the first feed page."""
+    import app.timeline as timeline
+    from app.db import init_db, connect
+
+    print("Checking pulled posts in home timelines...")
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "timeline.sqlite")
+        init_db(db_file)
+        conn = connect(db_file)
+        conn.execute("INSERT INTO user_profile (username, followers) VALUES ('star', 1)")
+        conn.execute("INSERT INTO following (follower, following) VALUES ('fan', 'star')")
+        conn.executemany("INSERT INTO posts (username, content) VALUES ('star', ?)",
+                         [(f"post {i}",) for i in range(30)])
+        conn.commit()
+        threshold = timeline.FANOUT_FOLLOWER_THRESHOLD
+        timeline.FANOUT_FOLLOWER_THRESHOLD = 1
+        try:
+            rows = timeline.read_home_timeline(conn.cursor(), "fan", 12)
+        finally:
+            timeline.FANOUT_FOLLOWER_THRESHOLD = threshold
+            conn.really_close()
+
+    if len(rows) != 12:
+        print(f"❌ First page has {len(rows)} pulled posts, expected 12")
+        return False
+    print("✅ Pulled posts appear on the first page")
+    return run_unpulled_author_checks()
+
+def run_unpulled_author_checks():
+    """An author who falls below the pull threshold gets their skipped posts pushed."""
+    import app.timeline as timeline
+    from app.db import init_db, connect
+
+    print("Checking authors that drop below the pull threshold...")
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "unpulled.sqlite")
+        init_db(db_file)
+        conn = connect(db_file)
+        c = conn.cursor()
+        c.execute("INSERT INTO user_profile (username, followers) VALUES ('star', 3)")
+        c.executemany("INSERT INTO following (follower, following) VALUES (?, 'star')",
+                      [("fan",), ("fan2",), ("fan3",)])
+        c.execute("INSERT INTO posts (username, content) VALUES ('star', 'pulled post')")
+        threshold = timeline.FANOUT_FOLLOWER_THRESHOLD
+        timeline.FANOUT_FOLLOWER_THRESHOLD = 2
+        try:
+            timeline._apply(c, ("post", c.lastrowid))
+            skipped = c.execute("SELECT COUNT(*) FROM home_timeline").fetchone()[0]
+            # two followers gone at once, as a stats recount would find it
+            c.execute("UPDATE user_profile SET followers = 1 WHERE username='star'")
+            timeline._apply(c, ("unpulled", None))
+            pushed = c.execute("SELECT COUNT(*) FROM home_timeline").fetchone()[0]
+            marked = c.execute("SELECT COUNT(*) FROM pulled_authors").fetchone()[0]
+        finally:
+            timeline.FANOUT_FOLLOWER_THRESHOLD = threshold
+            conn.really_close()
+
+    if skipped != 0 or pushed != 3 or marked != 0:
+        print(f"❌ Expected 0 rows while pulled, 3 after dropping below (got {skipped}, {pushed}), "
+              f"{marked} author(s) still marked pulled")
+        return False
+    print("✅ Skipped posts are pushed once the author is below the threshold")
+    return True
+
 if __name__ == "__main__":
+    if not run_query_plan_checks() or not run_home_timeline_checks():
+        sys.exit(1)
     run_tests()